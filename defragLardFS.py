@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Defragments a LARD image: every file whose sectors are spread over several
+runs gets moved into one run of neighbouring sectors. Run it on an image
+that isn't mounted, mount with waiter.py --defrag to do it online instead.
+Ctrl-C stops it, running it again carries on where it stopped.
+"""
+import argparse
+import sys
+
+from lardinator3000 import Image, Defragmenter
+
+
+def findPaths(image):
+    """
+    Walks the directory tree from the root and returns inode -> path.
+    """
+    paths = {0: "/"}
+    todo = [0]
+    while todo:
+        parent = todo.pop()
+        for _, name, inode in image.listDirectory(parent):
+            if name in (b".", b"..") or inode in paths:
+                continue
+            paths[inode] = paths[parent].rstrip("/") + "/" + name.decode(errors="replace")
+            if image.iNodes[inode].mode == 2:
+                todo.append(inode)
+    return paths
+
+
+def report(image, defrag, top):
+    """
+    Prints how fragmented the image is and the top most fragmented files.
+    """
+    stats = defrag.fragmentation()
+    fragmented = [s for s in stats if s[2] > 1]
+    runs = sum(s[2] for s in stats)
+    print(f"{len(stats)} files in {runs} runs, {len(fragmented)} fragmented, "
+          f"{runs / max(len(stats), 1):.2f} runs per file")
+    if top and fragmented:
+        paths = findPaths(image)
+        for inode, sectors, count in sorted(fragmented, key=lambda s: -s[2])[:top]:
+            print(f"{count:8d} runs {sectors:8d} sectors  {paths.get(inode, f'inode {inode + 1}')}")
+
+
+def parse_args(argv: list[str]):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("image_file", type=str,
+                        help="LARD-formatted disk image file")
+    parser.add_argument('--report', action='store_true', default=False,
+                        help='Only print how fragmented the image is, don\'t move anything')
+    parser.add_argument('--top', type=int, default=10,
+                        help='How many of the most fragmented files to list (default: %(default)s)')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Most MiB a second to move, 0 for as fast as it goes (default: %(default)s)')
+    parser.add_argument('--state', type=str, default=None,
+                        help='Where to remember progress between runs (default: IMAGE_FILE.defrag)')
+    parser.add_argument('--restart', action='store_true', default=False,
+                        help='Start over from the first inode instead of where the last run stopped')
+    return parser.parse_args(argv[1:])
+
+
+def main(argv: list[str]):
+    options = parse_args(argv)
+    image = Image(open(options.image_file, 'rb' if options.report else 'rb+'))
+    defrag = Defragmenter(image, rate=int(options.rate * 1024 * 1024),
+                          state=options.state or options.image_file + ".defrag")
+    try:
+        report(image, defrag, options.top)
+        if options.report:
+            return
+        if options.restart:
+            defrag.save(0)
+        try:
+            done = defrag.run()
+        except KeyboardInterrupt:
+            done = False
+        print(f"moved {defrag.sectors} sectors of {defrag.files} files, "
+              f"{defrag.skipped} had no free run long enough" + ("" if done else ", stopped early"))
+        report(image, defrag, 0)
+    finally:
+        image.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
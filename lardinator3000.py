@@ -1,7 +1,14 @@
 import sys
+import os
+import mmap
 import struct
 import datetime
 import time
+import heapq
+import threading
+import queue
+from collections import OrderedDict
+from contextlib import contextmanager
 
 def bread(fmt, data):
     """Takes a struct format string and data to read from to return the interpreted data"""
@@ -12,108 +19,600 @@ class Image:
     Holds the data and in memory portions of file. Also holds 
     all of the functions to interact with the file system.
     """
-    def __init__(self, image_file):
+    def __init__(self, image_file, cacheSize=8 << 20):
         self.image_file = image_file 
-        self.meta = MetaData(image_file.read()[:28])
+        self._fd = image_file.fileno()
+        self._mmap = None
+        self._store = None
+        self.cache = None
+        self.writable = any(c in getattr(image_file, "mode", "rb+") for c in "+wa")
+        try:
+            self._mmap = mmap.mmap(self._fd, 0, access=mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_READ)
+            self._store = memoryview(self._mmap)
+        except (ValueError, OSError): # empty or unmappable files fall back to pread/pwrite
+            self._mmap = None
+        self.meta = MetaData(self.read(0, 28))
+        if cacheSize > 0:
+            self.cache = SectorCache(self, cacheSize)
         self.iNodes = self.readIList()
+        self._freeInodes = [e for e, i in enumerate(self.iNodes) if i.mode == 0] # sorted, so already a min-heap
+        self._numFreeInodes = len(self._freeInodes)
         self.iMap = self.readIMap()
+        self._freeMap = bytearray(v == -1 for v in self.iMap) # 1 for every free sector
+        self._legacyLinks = self.findLegacyLinks()
+        self.reclaimer = Reclaimer(self)
+        self._numFreeImaps = self._freeMap.count(1)
+        self._nextImap = 0 # where the next-fit search for a free sector starts
+        self.chainCacheSize = 1 << 20 # max number of sector numbers kept across all cached chains
+        self._chains = OrderedDict() # inode -> list of sectors in its chain, least recently used first
+        self._chainSectors = 0
+        self._epochs = {} # inode -> bumped whenever its chain shrinks or moves, so cursors know they're stale
+        self._lastEpoch = 0 # epochs come from one counter so they never repeat, even once an inode's entry is gone
+        self.maxExtent = 256 # most sectors writeFile grabs ahead of an appending writer
+        self._extents = {} # inode -> size of the last extent writeFile grew it by
+        self._speculative = {} # inode -> chain index where the sectors writeFile grabbed ahead start
+        self.dirCacheSize = 1 << 20 # max number of directory slots kept across all cached directory indexes
+        self._dirs = OrderedDict() # inode -> DirIndex, least recently used first
+        self._dirSlots = 0
+        self._local = threading.local() # per-thread batch() depth
+        self._dirtyInodes = set()
+        self._dirtyImaps = set()
+        # lock order is inode locks, then _allocLock, then _indexLock, then the cache's lock
+        self._allocLock = threading.RLock() # free sector bitmap and free inode pool
+        self._indexLock = threading.RLock() # chain and directory caches and the dirty metadata sets
+        self._inodeLocks = {} # inode -> [RWLock, threads holding or waiting on it], only while that's more than 0
+        self._inodeLocksLock = threading.Lock()
+        if self.writable:
+            self.markLinks()
+
+    def inodeLock(self, inode):
+        """
+        Returns the InodeLock guarding an inode's data, chain and directory entries.
+        """
+        return InodeLock(self, inode)
+
+    def bumpEpoch(self, inode):
+        """
+        Moves an inode's chain on to a new epoch so every cursor into it goes
+        stale. Called with _indexLock held.
+        """
+        self._lastEpoch += 1
+        self._epochs[inode] = self._lastEpoch
+
+    @contextmanager
+    def batch(self):
+        """
+        Inside a batch writeInode and writeImap only remember what changed,
+        and when the outermost batch ends all of it goes out with one write
+        per run of touched sectors. Batches can nest.
+        """
+        self._local.batch = self.batchDepth() + 1
+        try:
+            yield self
+        finally:
+            self._local.batch -= 1
+            if self._local.batch == 0:
+                self.flushMetadata()
+
+    def batchDepth(self):
+        """
+        How many batch() blocks the calling thread is inside of.
+        """
+        return getattr(self._local, "batch", 0)
+
+    def flushMetadata(self):
+        """
+        Writes back the dirty inodes and imap entries. The in memory i-list
+        and i-map are complete, so whole sectors are packed from them
+        without reading anything back first.
+        """
+        with self._indexLock:
+            ssize = self.meta._ssize
+            if self._dirtyInodes:
+                perSector = ssize // 32
+                sectors = sorted({inode // perSector for inode in self._dirtyInodes})
+                for first, last in self.runs(sectors):
+                    nodes = self.iNodes[first * perSector:(last + 1) * perSector]
+                    self.write(self.meta.iListp + first * ssize, b"".join(i.toBytes() for i in nodes))
+                self._dirtyInodes.clear()
+            if self._dirtyImaps:
+                perSector = ssize // 4
+                sectors = sorted({imap // perSector for imap in self._dirtyImaps})
+                for first, last in self.runs(sectors):
+                    entries = self.iMap[first * perSector:(last + 1) * perSector]
+                    self.write(self.meta.iMapp + first * ssize, struct.pack(f">{len(entries)}i", *entries))
+                self._dirtyImaps.clear()
+
+    def flush(self):
+        """
+        Writes every dirty sector in the cache back to the image, data
+        first. Nothing is synced, so the OS may still write them out in any
+        order, sync is what keeps metadata behind its data.
+        """
+        self.flushMetadata()
+        if self.cache is not None:
+            self.cache.flush(self.cache.dataStart)
+            self.cache.flush()
+
+    def sync(self):
+        """
+        Makes everything written so far durable. Data sectors are written
+        back and synced before the i-list/i-map sectors that point at them,
+        so a crash never leaves metadata pointing at data that isn't there.
+        The metadata waits in the cache for this, so with the cache turned
+        off (cacheSize=0) there is no such ordering.
+        """
+        self.flushMetadata()
+        if self.cache is not None and self.cache.dirty:
+            self.cache.flush(self.meta.dPoolp // self.meta._ssize)
+            self.barrier()
+            self.cache.flush()
+        self.barrier()
+
+    def barrier(self):
+        """
+        Waits until everything handed to the image so far is on disk.
+        """
+        if self._mmap is not None and self.writable:
+            self._mmap.flush()
+        os.fdatasync(self._fd)
+
+    def close(self):
+        """
+        Syncs the cache and the mapping back to the image (data ahead of the
+        metadata, see sync) and closes everything.
+        """
+        self.reclaimer.close()
+        if self.writable:
+            self.sync()
+        else:
+            self.flush()
+        if self._mmap is not None:
+            self._store.release()
+            self._mmap.flush()
+            self._mmap.close()
+            self._mmap = None
+            self._store = None
+        self.image_file.close()
     
-    def getImaps(self, inode):
+    def getImaps(self, inode, stop=None, start=0, cursor=None):
         """
-        Return all the imap entries related to an inode.
+        Return all the imap entries related to an inode, or just
+        entries start through stop if they are given. With a ChainCursor
+        whose chain isn't cached anymore, we walk on from where the cursor
+        left off instead of building the whole chain from fip.
         """
-        res = [self.iNodes[inode].fip]
-        while True:
-            nv = self.iMap[res[-1]]
-            if nv >= 0:
-                res.append(nv)
-                continue
-            if nv == -1: # Might need different logic to handle this error
-                print("Ran into unallocated imap while attemtping to read inode")
-                exit(1)
-            break
-        return res
+        with self._indexLock:
+            chain = self._chains.get(inode)
+            epoch = self._epochs.get(inode, 0)
+        position = cursor.position if cursor is not None else None # one read, another thread may replace it
+        if chain is None and position is not None and stop is not None \
+                and position[0] == epoch and 0 <= position[1] <= start:
+            sector = position[2]
+            for _ in range(start - position[1]):
+                if sector < 0:
+                    break
+                sector = self.iMap[sector]
+            imaps = [sector] if sector >= 0 else [] # nothing left when start is past the end of the chain
+            while imaps and len(imaps) <= stop - start and self.iMap[imaps[-1]] >= 0:
+                imaps.append(self.iMap[imaps[-1]])
+        else:
+            chain = self.getChain(inode)
+            imaps = chain[start:] if stop is None else chain[start:stop + 1]
+        if cursor is not None and imaps:
+            cursor.position = (epoch, start + len(imaps) - 1, imaps[-1])
+        return imaps
+
+    def getChain(self, inode):
+        """
+        Returns the cached list of sectors in an inode's chain, walking the
+        imap from fip to build it the first time. The list is shared with
+        the cache, so only the chain methods below should modify it.
+        """
+        with self._indexLock:
+            chain = self._chains.get(inode)
+            if chain is not None:
+                self._chains.move_to_end(inode)
+                return chain
+            chain = [self.iNodes[inode].fip]
+            while True:
+                nv = self.iMap[chain[-1]]
+                if nv >= 0:
+                    chain.append(nv)
+                    continue
+                if nv == -1: # Might need different logic to handle this error
+                    print("Ran into unallocated imap while attemtping to read inode")
+                    exit(1)
+                break
+            self._chains[inode] = chain
+            self._chainSectors += len(chain)
+            self.trimChainCache()
+            return chain
+
+    def trimChainCache(self):
+        """
+        Evicts least recently used chains until we're under chainCacheSize.
+        The most recently used chain always stays.
+        """
+        with self._indexLock:
+            while self._chainSectors > self.chainCacheSize and len(self._chains) > 1:
+                _, chain = self._chains.popitem(last=False)
+                self._chainSectors -= len(chain)
+
+    def dropChain(self, inode):
+        """
+        Forgets the cached chain of an inode, used whenever fip changes.
+        """
+        with self._indexLock:
+            self.bumpEpoch(inode)
+            chain = self._chains.pop(inode, None)
+            if chain is not None:
+                self._chainSectors -= len(chain)
+
+    def growChain(self, inode, nsectors, written=None, extra=0):
+        """
+        Allocates and links sectors onto the end of an inode's chain
+        until it is nsectors long (plus extra sectors on top), then
+        returns the chain. New sectors at chain index written or later
+        are left for the caller to fill in completely, and the extra ones
+        lie past the end of the file, so only the ones before written get
+        zeroed (see zeroPastEnd for when the others do). We try for one
+        contiguous run right after the chain's last sector before taking
+        any free ones.
+        """
+        chain = self.getChain(inode)
+        count = nsectors - len(chain)
+        if count <= 0:
+            return chain
+        if written is None:
+            written = nsectors
+        holes = max(min(written, nsectors) - len(chain), 0)
+        extra = max(min(extra, self._numFreeImaps - count), 0) # grabbing ahead is never worth running out over
+        total = count + extra
+        # not under _indexLock, see the lock order in __init__
+        new = self.allocImaps(total, contiguous=True, zero=False, near=chain[-1] + 1) or self.allocImaps(total, zero=False)
+        self.zeroImaps(new[:holes])
+        for imap, nimap in zip(new, new[1:]):
+            self.iMap[imap] = nimap
+            self.writeImap(imap)
+        self.iMap[new[-1]] = -2
+        self.writeImap(new[-1]) # mark EOF before linking in case of crash
+        self.iMap[chain[-1]] = new[0]
+        self.writeImap(chain[-1])
+        with self._indexLock:
+            chain.extend(new)
+            if self._chains.get(inode) is chain:
+                self._chainSectors += total
+            self.trimChainCache()
+        return chain
     
 
+    def zeroPastEnd(self, inode, stop):
+        """
+        Zeroes the sectors of an inode's chain that lie wholly past the end
+        of the file, up to chain index stop, because the file is about to
+        grow over them. Nothing zeroes those when they're allocated (the
+        extra sectors of growChain, or a tail a crash kept trimPreallocation
+        from handing back), so they can hold anything until then.
+        """
+        ssize = self.meta._ssize
+        first = (self.iNodes[inode].size + ssize - 1) // ssize
+        if first < stop:
+            self.zeroImaps(self.getImaps(inode, stop - 1, first))
+
+    def warm(self):
+        """
+        Builds the chain of every file and the DirIndex of every directory
+        up front and lifts the cache limits so none of it gets evicted.
+        Meant for read-only mounts, where none of it ever changes again.
+        """
+        self.chainCacheSize = self.dirCacheSize = float("inf")
+        for e, i in enumerate(self.iNodes):
+            if i.mode != 0 and e not in self._legacyLinks: # those have their target's chain, or none at all
+                self.getChain(e)
+            if i.mode == 2:
+                self.getDirectory(e)
+
     def getNumFreeInodes(self) -> int:
         """
-        Calculates and returns the number of free inodes in the system
+        Returns the number of free inodes in the system
+        """
+        return self._numFreeInodes
+
+    def freeInode(self, inode):
+        """
+        Marks an inode as unallocated and hands it back to the free pool.
+        Like allocInode, writing it back is up to the caller. Its fip and
+        size get cleared so nothing mistakes a new owner of its sectors for
+        an old style link to it. Old style symlinks to it get a fip of -1
+        (written back right away), which marks them dangling for good, so
+        its sectors can go too.
+        """
+        with self._allocLock:
+            if self.iNodes[inode].mode != 0:
+                fip = self.iNodes[inode].fip
+                if inode not in self._legacyLinks:
+                    for link in self._legacyLinks:
+                        if self.iNodes[link].fip == fip:
+                            self.iNodes[link].fip = -1
+                            self.writeInode(link)
+                    self.reclaimer.release(fip) # its sectors go back in the background
+                self.iNodes[inode].mode = 0
+                self.iNodes[inode].fip = -1
+                self.iNodes[inode].size = 0
+                self.iNodes[inode].ownsTarget = False
+                heapq.heappush(self._freeInodes, inode)
+                self._numFreeInodes += 1
+            self.dropChain(inode)
+            with self._indexLock:
+                self._epochs.pop(inode, None)
+            self.dropDirectory(inode)
+            self._legacyLinks.discard(inode)
+            self._extents.pop(inode, None)
+            self._speculative.pop(inode, None)
+
+    def sharesChain(self, fip):
+        """
+        True if an old style symlink still points into the chain starting at fip.
+        """
+        return any(self.iNodes[link].fip == fip for link in self._legacyLinks)
+
+    def freeChain(self, head):
+        """
+        Walks a chain that nothing points at anymore from head and hands every
+        sector in it back to the free pool. Callers batch() it so the i-map
+        goes out a sector at a time instead of an entry at a time.
         """
         count = 0
+        while head >= 0 and not self._freeMap[head]:
+            nhead = self.iMap[head]
+            self.unallocateImap(head)
+            head = nhead
+            count += 1
+        return count
+
+    def sweepSectors(self):
+        """
+        Frees every allocated sector that no inode's chain reaches, like tails
+        detached by truncate that a crash kept the reclaimer from getting to.
+        Returns how many it freed.
+        """
+        reachable = bytearray(len(self.iMap))
         for i in self.iNodes:
             if i.mode == 0:
-                count += 1
+                continue
+            sector = i.fip
+            while sector >= 0 and not reachable[sector]:
+                reachable[sector] = 1
+                sector = self.iMap[sector]
+        sectors = (self.meta.imageSize - self.meta.dPoolp) // self.meta._ssize # the i-map's padding isn't real sectors
+        leaked = [s for s in range(sectors) if self.iMap[s] != -1 and not reachable[s]]
+        with self.batch():
+            for sector in leaked:
+                self.unallocateImap(sector)
+        return len(leaked)
 
-        return count
+    def sweepOrphans(self):
+        """
+        Frees every inode that's still allocated but has no links left, which
+        is what a file unlinked while it was open looks like after a crash.
+        Returns the inodes it freed.
+        """
+        orphans = [e for e, i in enumerate(self.iNodes) if i.mode != 0 and i.linkCount <= 0]
+        with self.batch():
+            for e in orphans:
+                self.freeInode(e)
+                self.writeInode(e)
+        return orphans
 
     def getNumFreeImaps(self) -> int:
         """
-        Calculates and returns the number of free blocks in the system
+        Returns the number of free blocks in the system
         """
-        count = 0
-        for i in self.iMap:
-            if i == -1 or i == 0:
-                count += 1
-
-        return count
+        return self._numFreeImaps
 
     def unallocateImap(self, imap):
         """
         Set an imap to unallocated. We zero out 
         dsectors when we alloc, so not here. 
         """
-        self.iMap[imap] = -1
-        self.writeImap(imap)
+        with self._allocLock:
+            self.iMap[imap] = -1
+            self.writeImap(imap)
+            if not self._freeMap[imap]:
+                self._freeMap[imap] = 1
+                self._numFreeImaps += 1
 
     def truncate(self, inode, nsize):
         """
         Truncate a file to a given size.
         """
-        ninode = self.iNodes[inode]
-        # do logic for unallocating blocks 
-        imaps = self.getImaps(inode)
-        for counter, imap in enumerate(imaps[::-1]): # iterate backwards in order to unallocate imaps at end of file first
-            if (ninode.size - counter * self.meta._ssize) // self.meta._ssize == nsize // self.meta._ssize:
-                self.iMap[imap] = -2 
-                self.writeImap(imap)
-                break
-            self.unallocateImap(imap)
-        imap = self.getImaps(inode)[-1]
-
-        # zero out block that the nsize truncate falls in
-        nsector = b'\0' * self.meta._ssize 
-        nsector = self.readSector(imap)[:nsize % self.meta._ssize] + nsector[nsize % self.meta._ssize:]
-        ninode.size = nsize
-        self.iNodes[inode] = ninode
-        self.writeInode(inode) # write inode first in case of crash
-        self.writeSector(imap, nsector)
+        with self.inodeLock(inode).writing(), self.batch():
+            ninode = self.iNodes[inode]
+            if nsize > ninode.size: # growing leaves a hole past the end of the chain that reads as zeroes
+                self.zeroPastEnd(inode, (nsize + self.meta._ssize - 1) // self.meta._ssize)
+                ninode.size = nsize
+                self.writeInode(inode)
+                return
+            # do logic for unallocating blocks, keeping the sector nsize falls in
+            keep = nsize // self.meta._ssize + 1
+            imap = self.detachTail(inode, keep)
+            self._speculative.pop(inode, None)
+            ninode.size = nsize
+            self.writeInode(inode) # write inode first in case of crash
+
+            # zero out block that the nsize truncate falls in
+            if imap is not None:
+                remainder = nsize % self.meta._ssize
+                self.writeSector(imap, self.readSector(imap)[:remainder] + b'\0' * (self.meta._ssize - remainder))
     
+    def detachTail(self, inode, keep):
+        """
+        Cuts an inode's chain down to keep sectors by marking the last one
+        EOF, and hands the rest to the reclaimer. Returns the last sector
+        kept, or None if the chain is shorter than keep. Only walks as far
+        as keep when the chain isn't cached, so cutting doesn't cost more
+        the longer the file was.
+        """
+        with self._indexLock:
+            chain = self._chains.get(inode)
+        if chain is not None:
+            if keep > len(chain):
+                return None
+            last = chain[keep - 1]
+        else:
+            last = self.iNodes[inode].fip
+            for _ in range(keep - 1):
+                last = self.iMap[last]
+                if last < 0:
+                    return None
+        tail = self.iMap[last]
+        if tail >= 0:
+            self.iMap[last] = -2
+            self.writeImap(last) # detach the tail, the reclaimer frees it in the background
+            self.reclaimer.release(tail)
+            with self._indexLock:
+                self.bumpEpoch(inode)
+                if chain is not None and self._chains.get(inode) is chain:
+                    self._chainSectors -= len(chain) - keep
+                    del chain[keep:]
+        return last
+
+    def preallocate(self, inode, offset, length, keepSize=False):
+        """
+        Makes sure the chain covers [offset, offset + length), allocating the
+        missing sectors as one contiguous run right after the chain if there's
+        room, zeroed like fallocate promises. Unless keepSize, the file grows
+        to cover the range too.
+        """
+        with self.inodeLock(inode).writing(), self.batch():
+            ssize = self.meta._ssize
+            self._speculative.pop(inode, None) # asked for explicitly, so release won't trim it
+            if not keepSize:
+                self.zeroPastEnd(inode, (offset + length + ssize - 1) // ssize)
+            self.growChain(inode, (offset + length + ssize - 1) // ssize)
+            if not keepSize and offset + length > self.iNodes[inode].size:
+                self.iNodes[inode].size = offset + length
+                self.writeInode(inode)
+
+    def trimPreallocation(self, inode):
+        """
+        Gives back the sectors writeFile grabbed ahead of an appending writer
+        that it never got to, called when the file is closed.
+        """
+        with self.inodeLock(inode).writing(), self.batch():
+            self._extents.pop(inode, None) # the next writer starts small again
+            start = self._speculative.pop(inode, None)
+            if start is not None:
+                ssize = self.meta._ssize
+                self.detachTail(inode, max(start, (self.iNodes[inode].size + ssize - 1) // ssize, 1))
+
+    def relocateChain(self, inode):
+        """
+        Moves an inode's sectors, in order, into one run of neighbouring
+        free sectors (the lowest one long enough) so the file reads front
+        to back in one sequential sweep. The copy and its i-map links are
+        synced before fip switches over in a single inode write, so a crash
+        leaves either the old chain or the new one (plus leaked sectors for
+        --sweep). The old chain goes to the reclaimer once the switch is
+        synced. Returns how many sectors moved, 0 if there was nothing to
+        do and None if there's no free run long enough.
+        """
+        with self.inodeLock(inode).writing():
+            node = self.iNodes[inode]
+            if node.mode == 0 or inode in self._legacyLinks or self.sharesChain(node.fip):
+                return 0
+            chain = list(self.getChain(inode))
+            if len(self.runs(chain)) == 1:
+                return 0
+            if len(chain) > self._numFreeImaps: # allocImaps would bail out of the whole program
+                return None
+            new = self.allocImaps(len(chain), contiguous=True, zero=False, near=0)
+            if new is None:
+                return None
+            ssize = self.meta._ssize
+            pos = 0
+            for first, last in self.runs(chain):
+                count = last - first + 1
+                self.writeSectors(new[pos], [self.read(self.meta.dPoolp + first * ssize, count * ssize)])
+                pos += count
+            with self.batch():
+                for imap, nimap in zip(new, new[1:]):
+                    self.iMap[imap] = nimap
+                    self.writeImap(imap)
+                self.iMap[new[-1]] = -2
+                self.writeImap(new[-1])
+            self.sync() # the copy has to be on disk before anything points at it
+            with self._allocLock: # freeInode reads fip under this lock, so it sees either chain whole
+                if node.mode == 0 or node.fip != chain[0]:
+                    old = new[0] # freed while we were copying, so drop the copy instead
+                else:
+                    old = node.fip
+                    node.fip = new[0]
+                    self.writeInode(inode)
+                    self.dropChain(inode)
+            self.sync()
+            self.reclaimer.release(old)
+            return len(chain) if old == chain[0] else 0
+
+    def extentFor(self, inode, needed):
+        """
+        How many sectors to grow a file by when it needs needed more. Each time
+        a file keeps growing we double the extent, up to maxExtent, so
+        streaming writers get long contiguous runs and allocate less often.
+        """
+        extent = min(max(needed, self._extents.get(inode, 4) * 2), max(self.maxExtent, needed))
+        self._extents[inode] = extent
+        return extent
+
     def wipe(self, inode):
         ninode = self.iNodes[inode]
-        data = self.read(ninode.offset)
         blank = (b'\x00' * 32)
-        data = blank + data[32:]
-        self.write(ninode.offset, data)
+        self.freeInode(inode)
+        self.write(ninode.offset, blank)
         self.iNodes[inode] = INode(blank, ninode.offset)
             
-    def read(self, offset):
+    def read(self, offset, size=None):
+        """
+        Reads size bytes (a sector by default) from offset in the file,
+        going through the sector cache if there is one.
+        """
+        if size is None:
+            size = self.meta._ssize
+        if self.cache is not None:
+            return self.cache.read(offset, size)
+        return self.readStore(offset, size)
+
+    def view(self, offset, size=None):
         """
-        Reads size bytes from offset in the file.
+        Same as read but hands out a zero-copy slice of the mapping (or of
+        the cached sector) when there is one. Don't hold onto it across writes.
+        Unlike read this never pulls sectors into the cache.
         """
-        self.image_file.seek(offset)
-        return self.image_file.read()[:self.meta._ssize]
+        if size is None:
+            size = self.meta._ssize
+        if self.cache is not None:
+            cached = self.cache.view(offset, size)
+            if cached is not None:
+                return cached
+        if self._store is not None:
+            return self._store[offset:offset + size]
+        return memoryview(os.pread(self._fd, size, offset))
+
+    def readStore(self, offset, size):
+        """
+        Reads exactly size bytes from offset in the image itself, skipping the cache.
+        """
+        if self._store is not None:
+            return self._store[offset:offset + size].tobytes()
+        return os.pread(self._fd, size, offset)
     
     def readIList(self):
         """
         Reads in INodes from IList and stores them in memory.
         """
         size = self.meta.iMapp - self.meta.iListp
-        data = b""
-        amountRead = 0
-        while size - amountRead > 0:
-            data += self.read(self.meta.iListp + amountRead)
-            amountRead += self.meta._ssize
-        data = data[:size]
+        data = self.read(self.meta.iListp, size)
         res = []
         for i in range(len(data) // 32): # Each i-node is 32 bytes in length
             offset = i * 32
@@ -125,33 +624,76 @@ class Image:
         Reads in all IMap entries into memory.
         """
         size = self.meta.dPoolp - self.meta.iMapp
-        data = b""
-        amountRead = 0
-        while size - amountRead > 0:
-            data += self.read(self.meta.iMapp + amountRead)
-            amountRead += self.meta._ssize
-        data = data[:size]
-        res = []
-        for i in range(len(data) // 4):
-            offset = i * 4
-            res.append(bread("i", data[offset: offset + 4]))
-        return res
+        data = self.read(self.meta.iMapp, size)
+        return list(struct.unpack(f">{len(data) // 4}i", data[:len(data) // 4 * 4]))
 
     def readSector(self, imap):
         """Return data from a given data sector as indexed by imap."""
         return self.read(self.meta.dPoolp + imap * self.meta._ssize)
 
+    def viewSector(self, imap):
+        """Zero-copy version of readSector."""
+        return self.view(self.meta.dPoolp + imap * self.meta._ssize)
+
     def readDirectory(self, inode):
         """
-        A wrapper that uses readFile but parses into DirectoryEntries afterwards.
+        Returns the DirectoryEntries of a directory in the order they sit
+        in the directory file, skipping the empty ones.
         """
-        file = self.readFile(inode)
-        res = []
-        for i in range(self.iNodes[inode].size // 32):
-            entry = DirectoryEntry(file.data[i * 32: (i + 1) * 32]) 
-            if entry.name != "":
-                res.append(entry)
-        return res
+        return [DirectoryEntry(struct.pack(">i28s", ninode, name)) for _, name, ninode in self.listDirectory(inode)]
+
+    def listDirectory(self, inode, start=0, count=None):
+        """
+        Returns up to count (slot, name, inode) tuples for the entries of a
+        directory sitting at slot start or later, in slot order. Slots don't
+        move until compactDirectory, so the slot after the last one returned
+        is a stable place to carry on from.
+        """
+        with self.inodeLock(inode).reading():
+            index = self.getDirectory(inode)
+            entries = []
+            for slot in range(start, index.slots):
+                name = index.slotNames[slot]
+                if name is not None:
+                    entries.append((slot, name, index.names[name][0]))
+                    if len(entries) == count:
+                        break
+            return entries
+
+    def getDirectory(self, inode):
+        """
+        Returns the DirIndex of a directory, reading the directory
+        file with readFile to build it the first time.
+        """
+        with self._indexLock:
+            index = self._dirs.get(inode)
+            if index is not None:
+                self._dirs.move_to_end(inode)
+                return index
+            index = DirIndex(self.readFile(inode).data)
+            self._dirs[inode] = index
+            self._dirSlots += index.slots
+            while self._dirSlots > self.dirCacheSize and len(self._dirs) > 1:
+                _, old = self._dirs.popitem(last=False)
+                self._dirSlots -= old.slots
+            return index
+
+    def dropDirectory(self, inode):
+        """
+        Forgets the cached DirIndex of an inode.
+        """
+        with self._indexLock:
+            index = self._dirs.pop(inode, None)
+            if index is not None:
+                self._dirSlots -= index.slots
+
+    def lookupDirectory(self, inode, name):
+        """
+        Returns the inode that name (in bytes) links to in
+        the given directory, or None if there isn't one.
+        """
+        found = self.getDirectory(inode).names.get(name)
+        return None if found is None else found[0]
             
     def readFile(self, inode):
         """
@@ -159,27 +701,168 @@ class Image:
         chaining together until we reach inode.size data.
         """
         imaps = self.getImaps(inode)
-        data = b""
-        for index in imaps:
-            data += self.readSector(index)
-        return FileEntry(data[:self.iNodes[inode].size])
+        data = b"".join(self.viewSector(index) for index in imaps)
+        return FileEntry(data[:self.iNodes[inode].size].ljust(self.iNodes[inode].size, b"\0")) # a hole at the end reads as zeroes
+
+    def readRange(self, inode, off, size, cursor=None):
+        """
+        Reads size bytes starting at off from the file designated by inode.
+        Only the sectors covering [off, off + size) are touched and they are
+        copied straight into one preallocated buffer. An open file passes
+        its ChainCursor so the next read continues where this one ended.
+        """
+        with self.inodeLock(inode).reading():
+            fsize = self.iNodes[inode].size
+            if size <= 0 or off >= fsize:
+                return b""
+            size = min(size, fsize - off)
+            ssize = self.meta._ssize
+            first = off // ssize
+            last = (off + size - 1) // ssize
+            imaps = self.getImaps(inode, last, first, cursor) # can come up short, holes at the end stay zeroes
+            buffer = bytearray(size)
+            start = off % ssize
+            pos = 0
+            for imap in imaps:
+                amount = min(ssize - start, size - pos)
+                buffer[pos:pos + amount] = self.viewSector(imap)[start:start + amount]
+                pos += amount
+                start = 0
+            return bytes(buffer)
+
+    def prefetch(self, inode, off, size):
+        """
+        Resolves the chain covering [off, off + size) of a file and tells
+        the kernel we're about to read those sectors, one hint per run of
+        neighbouring sectors, so they're in the page cache by the time we do.
+        Runs on the readahead thread, so it takes the read lock like readRange
+        to keep truncate and the reclaimer from changing the chain mid-walk.
+        """
+        with self.inodeLock(inode).reading():
+            size = min(size, self.iNodes[inode].size - off)
+            if size <= 0:
+                return
+            ssize = self.meta._ssize
+            for first, last in self.runs(self.getImaps(inode, (off + size - 1) // ssize, off // ssize)):
+                start = self.meta.dPoolp + first * ssize
+                length = (last - first + 1) * ssize
+                if self._mmap is not None and hasattr(mmap, "MADV_WILLNEED"):
+                    aligned = start - start % mmap.PAGESIZE
+                    self._mmap.madvise(mmap.MADV_WILLNEED, aligned, min(length + start - aligned, len(self._mmap) - aligned))
+                elif hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(self._fd, start, length, os.POSIX_FADV_WILLNEED)
 
     def allocImap(self):
         """
-        Finds the first available unallocated imap,
-        zeroes it out and returns its index.
+        Finds the next available unallocated imap after the last one we
+        handed out, zeroes it out and returns its index. The caller is
+        expected to link it into a chain.
+        """
+        return self.allocImaps(1)[0]
+
+    def allocImaps(self, count, contiguous=False, zero=True, near=None):
+        """
+        Allocates and zeroes count imaps and returns their indexes. With
+        contiguous they are a single run of neighbouring sectors, and if
+        there is no run that long we return None instead, near is where
+        to start looking for the run. Callers about to overwrite the
+        sectors anyway pass zero=False to skip zeroing.
+        If we are out of sectors we print an error and die.
         """
-        for i in range(len(self.iMap)):
-            if self.iMap[i] == -1:
-                self.writeSector(i, b"\0" * self.meta._ssize) # zero out block
-                return i
+        with self._allocLock:
+            if count > self._numFreeImaps:
+                print("lardinator3000 ERROR: out of sectors")
+                exit(-1)
+            if contiguous:
+                run = b"\1" * count
+                start = self._freeMap.find(run, self._nextImap if near is None else near)
+                if start == -1:
+                    start = self._freeMap.find(run)
+                if start == -1:
+                    return None
+                res = list(range(start, start + count))
+            else:
+                res = []
+                while len(res) < count:
+                    start = self._freeMap.find(1, self._nextImap)
+                    if start == -1:
+                        start = self._freeMap.find(1)
+                    end = self._freeMap.find(0, start)
+                    if end == -1:
+                        end = len(self._freeMap)
+                    end = min(end, start + count - len(res))
+                    self._freeMap[start:end] = bytes(end - start)
+                    res.extend(range(start, end))
+                    self._nextImap = end
+            for first, last in self.runs(res):
+                self._freeMap[first:last + 1] = bytes(last - first + 1)
+            if zero:
+                self.zeroImaps(res)
+            self._numFreeImaps -= count
+            self._nextImap = (res[-1] + 1) % len(self._freeMap)
+            return res
+
+    def zeroImaps(self, imaps):
+        """
+        Zeroes out the given sectors, one write per run of neighbouring ones.
+        """
+        for first, last in self.runs(imaps):
+            self.write(self.meta.dPoolp + first * self.meta._ssize, bytes((last - first + 1) * self.meta._ssize))
+
+    @staticmethod
+    def runs(imaps):
+        """
+        Splits a list of imaps into (first, last) runs of consecutive sectors.
+        """
+        res = []
+        for imap in imaps:
+            if res and res[-1][1] + 1 == imap:
+                res[-1][1] = imap
+            else:
+                res.append([imap, imap])
+        return [tuple(run) for run in res]
 
     def write(self, offset, sector):
         """
-        Writes a sector at the given offset in the file.
+        Writes a sector (or any exact-length chunk) at the given offset in the file,
+        going through the sector cache if there is one.
+        """
+        if self.cache is not None:
+            self.cache.write(offset, sector)
+        else:
+            self.writeStore(offset, sector)
+
+    def writeStore(self, offset, sector):
+        """
+        Writes sector at offset in the image itself, skipping the cache.
+        """
+        if self._store is not None:
+            self._store[offset:offset + len(sector)] = sector
+            return
+        view = memoryview(sector)
+        while len(view):
+            written = os.pwrite(self._fd, view, offset)
+            view = view[written:]
+            offset += written
+
+    def writeStoreVector(self, offset, buffers):
+        """
+        Writes buffers one after another from offset in the image itself,
+        skipping the cache. Without the mmap that's one pwritev for the lot.
         """
-        self.image_file.seek(offset)
-        self.image_file.write(sector)
+        if self._store is not None or not hasattr(os, "pwritev"):
+            for buffer in buffers:
+                self.writeStore(offset, buffer)
+                offset += len(buffer)
+            return
+        views = [memoryview(buffer) for buffer in buffers]
+        while views:
+            written = os.pwritev(self._fd, views[:1024], offset) # 1024 is IOV_MAX on linux
+            offset += written
+            while views and written >= len(views[0]):
+                written -= len(views.pop(0))
+            if written:
+                views[0] = views[0][written:]
 
     def writeSector(self, imap, sector):
         """
@@ -187,135 +870,919 @@ class Image:
         """
         self.write(self.meta.dPoolp + imap * self.meta._ssize, sector)
 
+    def writeSectors(self, imap, buffers):
+        """
+        Writes buffers (whole sectors' worth between them) back to back into
+        the neighbouring sectors starting at imap. A single sector goes
+        through writeSector like always, anything longer goes straight to
+        the image in one go and just refreshes whatever the cache has of it.
+        """
+        offset = self.meta.dPoolp + imap * self.meta._ssize
+        if len(buffers) == 1 and len(buffers[0]) == self.meta._ssize:
+            self.write(offset, buffers[0])
+            return
+        if self.cache is not None:
+            pos = offset
+            for buffer in buffers:
+                self.cache.overwrite(pos, buffer)
+                pos += len(buffer)
+        self.writeStoreVector(offset, buffers)
+
     def writeInode(self, inode):
         """
         Writes an inode back to the file without
-        modifying the surrounding inodes.
+        modifying the surrounding inodes. Inside a batch
+        this waits for the batch to end.
         """
-        location = self.iNodes[inode].offset
-        data = self.read(location)
-        data = self.iNodes[inode].toBytes() + data[32:]
-        self.write(location, data)
+        if self.batchDepth():
+            with self._indexLock:
+                self._dirtyInodes.add(inode)
+            return
+        self.write(self.iNodes[inode].offset, self.iNodes[inode].toBytes())
 
     def writeImap(self, imap):
         """
-        Writes back the in memory imap to disk.
+        Writes back the in memory imap to disk. Inside a
+        batch this waits for the batch to end.
         """
-        location = self.meta.iMapp + imap * 4
-        data = self.read(location)
-        data = struct.pack(">i", self.iMap[imap]) + data[4:]
-        self.write(location, data)
+        if self.batchDepth():
+            with self._indexLock:
+                self._dirtyImaps.add(imap)
+            return
+        self.write(self.meta.iMapp + imap * 4, struct.pack(">i", self.iMap[imap]))
     
     def writeDirectory(self, parent_inode, *, inode=-1, name, delete=False):
         """
         Takes in an inode to put an entry into, the parent_inode, an
         inode to link to, and a name and adds an entry to said parent_inode.
         """
-        if delete:
-            payload = b'\x00' * 32
-        else:
-            payload = struct.pack(">i28s", inode, name) 
-        data = self.readDirectory(parent_inode)
-        offset = -1
-        for e, dir in enumerate(data):  # find empty dir spot
-            if delete and dir.name.encode() == name:
-                offset = e * 32
-                break
-            elif dir.name == "":
-                offset = e * 32
-                break
-        if offset == -1:  # if no open dir entry in all the blocks, then we need to allocate a new block
-            offset = len(data) * 32
-        self.writeFile(parent_inode, offset, payload)
-        self.iNodes[parent_inode].linkCount += 1
-        if not delete:
-            self.writeInode(inode)
+        with self.inodeLock(parent_inode).writing():
+            index = self.getDirectory(parent_inode)
+            if delete:
+                payload = b'\x00' * 32
+                found = index.names.pop(name, None)
+                if found is None:
+                    return
+                slot = found[1]
+                heapq.heappush(index.free, slot)
+                index.slotNames[slot] = None
+            else:
+                payload = struct.pack(">i28s", inode, name) 
+                if name in index.names:  # replace an existing entry in place
+                    slot = index.names[name][1]
+                elif index.free:  # reuse the first empty dir spot
+                    slot = heapq.heappop(index.free)
+                else:  # if no open dir entry in all the blocks, then we need to allocate a new block
+                    slot = index.slots
+                    index.slots += 1
+                    index.slotNames.append(None)
+                    self._dirSlots += 1
+                index.names[name] = (inode, slot)
+                index.slotNames[slot] = name
+            self.writeSlot(parent_inode, slot, payload)
+            if not delete:
+                self.iNodes[parent_inode].linkCount += 1
+                self.writeInode(inode)
+
+    def writeSlot(self, inode, slot, payload):
+        """
+        Writes a 32 byte entry into a slot of a directory. Slots inside the
+        directory are updated in place, only a new slot at the end needs
+        writeFile to grow the directory.
+        """
+        offset = slot * 32
+        if offset + 32 > self.iNodes[inode].size:
+            self.writeFile(inode, offset, payload)
+            return
+        ssize = self.meta._ssize
+        imap = self.getChain(inode)[offset // ssize]
+        self.write(self.meta.dPoolp + imap * ssize + offset % ssize, payload)
+
+    def renameDirectory(self, old_parent, old_name, new_parent, new_name):
+        """
+        Moves the entry old_name in old_parent to new_name in new_parent.
+        Renames within a directory just rewrite the entry's slot.
+        """
+        first, second = sorted((old_parent, new_parent))
+        with self.inodeLock(first).writing(), self.inodeLock(second).writing():
+            index = self.getDirectory(old_parent)
+            inode, slot = index.names[old_name]
+            if old_parent == new_parent and new_name not in index.names:
+                del index.names[old_name]
+                index.names[new_name] = (inode, slot)
+                index.slotNames[slot] = new_name
+                self.writeSlot(old_parent, slot, struct.pack(">i28s", inode, new_name))
+                return
+            self.writeDirectory(old_parent, name=old_name, delete=True)
+            self.writeDirectory(new_parent, inode=inode, name=new_name)
+
+    def compactDirectory(self, inode):
+        """
+        Squeezes the empty slots left by deletes out of a directory, moving
+        the entries down in order and truncating the leftover slots away.
+        """
+        with self.inodeLock(inode).writing():
+            index = self.getDirectory(inode)
+            if not index.free:
+                return
+            entries = self.listDirectory(inode)
+            data = b"".join(struct.pack(">i28s", ninode, name) for _, name, ninode in entries)
+            if data:
+                self.writeFile(inode, 0, data)
+            self.truncate(inode, len(data))
+            self.dropDirectory(inode)
 
-    def writeFile(self, inode, offset, data):
+    def compactSparseDirectory(self, inode, ratio):
+        """
+        Compacts a directory once it has more than ratio empty slots for
+        every used one, and at least a sector's worth of them so compacting
+        gives something back. Returns whether it did.
+        """
+        with self.inodeLock(inode).writing(), self.batch():
+            index = self.getDirectory(inode)
+            if len(index.free) < self.meta._ssize // 32 or len(index.free) <= ratio * len(index.names):
+                return False
+            self.compactDirectory(inode)
+            return True
+
+    def writeFile(self, inode, offset, data, cursor=None, ahead=False):
         """
         Writes data to the file designated by inode 
         at offset and updates relating metadata. 
-        Expands file if necessary.
-        """
-        if offset >  self.iNodes[inode].size:
-            print("Tried to write after the end of a file")
-            exit(1)
-        if offset + len(data) > self.iNodes[inode].size:  # expand inode size if necessary
-            self.iNodes[inode].size = offset + len(data)
-            self.writeInode(inode)
-        imaps = self.getImaps(inode)
-        if offset // self.meta._ssize > (len(imaps) - 1): # allocate imaps if necessary
-            nimap = self.allocImap()
-            self.iMap[imaps[-1]] = nimap
-            self.iMap[nimap] = -2
-            self.writeImap(imaps[-2])
-            self.writeImap(imaps[-1])
-            imaps = self.getImaps(inode)
-        remainder = offset % self.meta._ssize
-        location = imaps[offset // self.meta._ssize]  # find first sector that we need to write to
-        sector = self.readSector(location)
-        if self.meta._ssize >= len(data) + remainder:  # first sector write
-            sector = sector[:remainder] + data + sector[remainder + len(data):]
-            self.writeSector(location, sector)
-        else:
-            amountWritten = self.meta._ssize - remainder  # write to more sectors as long as there's more data to write
-            sector = sector[:remainder] + data[:amountWritten]
-            self.writeSector(location, sector)
-            while True:
-                nlocation = self.iMap[location]
-                if location == -2:
-                    nlocation = self.allocImap()
-                    self.iMap[location] = nlocation
-                    self.writeImap(location)
-                sector = self.readSector(location)
-                if self.meta._ssize >= len(data) - amountWritten:
-                    sector = data[amountWritten:] + sector[len(data) - amountWritten:]
-                    self.writeSector(nlocation, sector)
-                    return 0
-                sector = data[amountWritten:amountWritten + self.meta._ssize]
-                self.writeSector(nlocation, sector)
-                amountWritten += self.meta._ssize
-                location = nlocation
+        Expands file if necessary, writing past the end leaves
+        a hole of zeroes. Like readRange it takes an optional
+        ChainCursor for writes that don't grow the chain.
+        With ahead it grabs sectors past the end for the writes
+        to come (see extentFor), callers that pass it have to
+        trimPreallocation once the writer is done.
+        """
+        with self.inodeLock(inode).writing(), self.batch():
+            ssize = self.meta._ssize
+            if not data:
+                return 0
+            first = offset // ssize
+            last = (offset + len(data) - 1) // ssize
+            size = self.iNodes[inode].size
+            if offset + len(data) > size: # expand inode size
+                self.zeroPastEnd(inode, first) # a write past the end exposes the sectors it skips
+                self.iNodes[inode].size = offset + len(data)
+                self.writeInode(inode)
+            imaps = self.getImaps(inode, last, first, cursor)
+            # sectors from here on are new or wholly past the old end, so they only hold what we write
+            fresh = min(len(imaps), max((size + ssize - 1) // ssize - first, 0))
+            if len(imaps) < last - first + 1: # runs past the end of the chain, so allocate imaps
+                length = len(self.getChain(inode))
+                fresh = min(fresh, max(length - first, 0))
+                extra = self.extentFor(inode, last + 1 - length) - (last + 1 - length) if ahead else 0
+                if extra:
+                    self._speculative.setdefault(inode, last + 1)
+                imaps = self.growChain(inode, last + 1, first, extra)[first:last + 1]
+            view = memoryview(data)
+            head = offset % ssize # data starts this far into sector 0 and ends at end
+            end = head + len(data)
+            count = last - first + 1
+            partial = {} # the head and tail sectors if the write only covers part of them, built up in full
+            for index in {0, count - 1}:
+                lo, hi = max(head - index * ssize, 0), min(end - index * ssize, ssize)
+                if hi - lo == ssize:
+                    continue
+                chunk = view[index * ssize + lo - head:index * ssize + hi - head]
+                if index >= fresh: # a new sector is zeroes around what we write
+                    partial[index] = bytes(lo) + chunk + bytes(ssize - hi)
+                else: # only part of the sector changes, so keep the rest of it
+                    sector = self.readSector(imaps[index])
+                    partial[index] = sector[:lo] + chunk + sector[hi:]
+            # everything in between is whole sectors we never read, each run of neighbouring sectors goes out in one write
+            start = 0
+            for index in range(1, count + 1):
+                if index < count and imaps[index] == imaps[index - 1] + 1:
+                    continue
+                buffers = [partial[start]] if start in partial else []
+                lo = start + 1 if start in partial else start
+                hi = index - 1 if index - 1 in partial and index - 1 >= lo else index
+                if lo < hi:
+                    buffers.append(view[lo * ssize - head:hi * ssize - head])
+                if hi < index:
+                    buffers.append(partial[hi])
+                self.writeSectors(imaps[start], buffers)
+                start = index
+            return 0
 
     def allocInode(self, filetype: int, modeBits: int) -> int:
         """
-        Finds the first free inode and allocates it using inodeType with the given modeBits
+        Takes the lowest free inode out of the pool and allocates it using inodeType with the given modeBits
         If there are no inodes left we print an error and die.
         """
-        for e, i in enumerate(self.iNodes):
-            if i.mode == 0: # 0 == unallocated
-                i.mode = filetype
-                i.s_ugt = (modeBits & 0x0E00) >> 9
-                i.user = (modeBits & 0x01C0) >> 6
-                i.group = (modeBits & 0x0038) >> 3
-                i.other = modeBits & 0x0007
-                i.linkCount = 0x01
-                i.ownerUID = 0x03E8
-                i.ownerGID = 0x03E8
-                i.cTime = int(time.mktime((datetime.datetime.now()).timetuple()) * 1e9) # gets the current time and converts it to unix timestamp, convert to int to truncate 
-                i.mTime = i.cTime
-                i.aTime = i.cTime
-                i.size = 0
-                if i.mode != 3:  # if file is a symlink, we don't allocate a new imap
-                    i.fip = self.allocImap() # assign first free Imap
-                self.iMap[i.fip] = -2 # mark as EOF
-                self.writeImap(i.fip) # write to file
-                return e 
-
-        print("lardinator3000 ERROR: out of inodes")
-        exit(-1)
+        with self._allocLock:
+            while self._freeInodes:
+                e = heapq.heappop(self._freeInodes)
+                i = self.iNodes[e]
+                if i.mode == 0: # 0 == unallocated, anything else is a stale pool entry
+                    self._numFreeInodes -= 1
+                    i.mode = filetype
+                    i.s_ugt = (modeBits & 0x0E00) >> 9
+                    i.user = (modeBits & 0x01C0) >> 6
+                    i.group = (modeBits & 0x0038) >> 3
+                    i.other = modeBits & 0x0007
+                    i.linkCount = 0x01
+                    i.ownerUID = 0x03E8
+                    i.ownerGID = 0x03E8
+                    i.cTime = int(time.mktime((datetime.datetime.now()).timetuple()) * 1e9) # gets the current time and converts it to unix timestamp, convert to int to truncate 
+                    i.mTime = i.cTime
+                    i.aTime = i.cTime
+                    i.size = 0
+                    i.ownsTarget = False
+                    self.dropChain(e)
+                    with self._indexLock:
+                        self._epochs.pop(e, None) # nothing has a cursor into a brand new file
+                    self.dropDirectory(e)
+                    self._legacyLinks.discard(e)
+                    i.fip = self.allocImap() # assign first free Imap, symlinks keep their target path in it
+                    self.iMap[i.fip] = -2 # mark as EOF
+                    self.writeImap(i.fip) # write to file
+                    return e 
+
+            print("lardinator3000 ERROR: out of inodes")
+            exit(-1)
     
-    def softLinkInode(self, targetInodeNum: int, newInodeNum: int):
+    def writeLink(self, inode, target):
         """
-        Copies the necessary data over from targetInode to create a soft link to target
+        Stores the target path of a freshly allocated symlink in its own
+        data sector(s), so readLink never has to go looking for it, and
+        sets ownsTarget so it never gets taken for an old style link.
         """
-        self.iNodes[newInodeNum].ownerUID = self.iNodes[targetInodeNum].ownerUID
-        self.iNodes[newInodeNum].ownerGID = self.iNodes[targetInodeNum].ownerGID
-        self.iNodes[newInodeNum].size = self.iNodes[targetInodeNum].size
-        self.iNodes[newInodeNum].fip = self.iNodes[targetInodeNum].fip
-        self.iNodes[targetInodeNum].mTime = int(time.mktime((datetime.datetime.now()).timetuple()))
-        self.iNodes[targetInodeNum].linkCount += 1
-        return
+        self.iNodes[inode].ownsTarget = True
+        self.writeFile(inode, 0, target)
+        self.writeInode(inode)
+
+    def readLink(self, inode):
+        """
+        Returns the target path of a symlink, or None for symlinks from the
+        old layout, which share their target's fip instead of storing a path.
+        """
+        if inode in self._legacyLinks:
+            return None
+        return self.readRange(inode, 0, self.iNodes[inode].size)
+
+    def findLegacyLinks(self):
+        """
+        Finds the symlinks made back when softLinkInode copied the target's
+        fip into the link. Links with ownsTarget set never are, for the rest
+        we have to guess. Those share a fip with a regular file or directory,
+        or with a freed one if the target has been deleted since. Freed
+        inodes keep a stale fip that a new link may have been given, so
+        sharing one with a freed inode only counts if the link has the
+        dead file's size or doesn't hold something that could be a path.
+        Links whose fip sector is free, or whose fip is -1 (see freeInode),
+        are dangling old ones too, a new style link always owns its sector.
+        """
+        fips = {i.fip for i in self.iNodes if i.mode not in (0, 3)}
+        dead = {}
+        for i in self.iNodes:
+            if i.mode == 0:
+                dead.setdefault(i.fip, set()).add(i.size)
+        links = set()
+        for e, i in enumerate(self.iNodes):
+            if i.mode != 3 or i.ownsTarget:
+                continue
+            if i.fip in fips or not 0 <= i.fip < len(self.iMap) or self.iMap[i.fip] == -1:
+                links.add(e)
+            elif i.fip in dead:
+                start = self.read(self.meta.dPoolp + i.fip * self.meta._ssize, min(i.size, self.meta._ssize)) if i.size > 0 else b""
+                if i.size in dead[i.fip] or not 0 < i.size < 4096 or b"\0" in start: # a path has no NULs and fits in PATH_MAX
+                    links.add(e)
+        return links
+
+    def markLinks(self):
+        """
+        Sets ownsTarget on the new style symlinks made before it existed, so
+        findLegacyLinks only has to guess about them on the first mount.
+        """
+        with self.batch():
+            for e, i in enumerate(self.iNodes):
+                if i.mode == 3 and not i.ownsTarget and e not in self._legacyLinks:
+                    i.ownsTarget = True
+                    self.writeInode(e)
+
+
+class ChainCursor:
+    """
+    Remembers where in an inode's chain an open file's last read or write
+    ended, as a (chain index, sector) pair. epoch goes stale as soon as
+    the chain shrinks or moves, and then the cursor just gets ignored.
+    Concurrent reads of one handle share a cursor, so position holds all
+    three as one tuple that only ever gets read or replaced whole.
+    """
+    def __init__(self):
+        self.position = (-1, -1, -1) # (epoch, index, sector)
+
+    @property
+    def epoch(self):
+        return self.position[0]
+
+    @property
+    def index(self):
+        return self.position[1]
+
+    @property
+    def sector(self):
+        return self.position[2]
+
+    def __repr__(self):
+        return f"ChainCursor(index={self.index}, sector={self.sector})"
+
+
+class WriteBuffer:
+    """
+    Gathers small writes to one open file that land next to (or on top
+    of) each other, so they reach the image as one bigger writeFile
+    instead of a read-modify-write of the same sector for every one.
+    """
+    def __init__(self, limit=128 * 1024):
+        self.limit = limit
+        self.offset = 0
+        self.data = bytearray()
+
+    def __len__(self):
+        return len(self.data)
+
+    def end(self):
+        return self.offset + len(self.data)
+
+    def add(self, off, data):
+        """
+        Buffers data at off and returns True, or returns False if it doesn't
+        fit: too big, not touching what's buffered, or it would overflow limit.
+        """
+        if not self.data:
+            if len(data) >= self.limit:
+                return False
+            self.offset = off
+        elif not self.offset <= off <= self.end() or off + len(data) - self.offset > self.limit:
+            return False
+        self.data[off - self.offset:off - self.offset + len(data)] = data
+        return True
+
+    def take(self):
+        """
+        Empties the buffer and returns what was in it as (offset, data).
+        """
+        pending = (self.offset, bytes(self.data))
+        self.data.clear()
+        return pending
+
+    def __repr__(self):
+        return f"WriteBuffer(offset={self.offset}, size={len(self.data)})"
+
+
+class DentryCache:
+    """
+    LRU of name lookups, (parent inode, name) -> inode, or None when the
+    name isn't in the directory. Keeps the cached names of every parent
+    too, so a directory that goes away can be dropped in one go.
+    """
+    def __init__(self, size=65536):
+        self.size = size
+        self.entries = OrderedDict()
+        self.parents = {} # parent -> set of names cached under it
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, parent, name):
+        """
+        Returns (True, inode or None) on a hit and (False, None) on a miss.
+        """
+        key = (parent, name)
+        if key not in self.entries:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return True, self.entries[key]
+
+    def put(self, parent, name, inode):
+        self.entries[(parent, name)] = inode
+        self.entries.move_to_end((parent, name))
+        self.parents.setdefault(parent, set()).add(name)
+        while len(self.entries) > self.size:
+            (oldParent, oldName), _ = self.entries.popitem(last=False)
+            self.forgetName(oldParent, oldName)
+
+    def drop(self, parent, name):
+        if self.entries.pop((parent, name), False) is not False:
+            self.forgetName(parent, name)
+
+    def dropParent(self, parent):
+        for name in self.parents.pop(parent, ()):
+            del self.entries[(parent, name)]
+
+    def forgetName(self, parent, name):
+        names = self.parents[parent]
+        names.discard(name)
+        if not names:
+            del self.parents[parent]
+
+    def __repr__(self):
+        return f"DentryCache({len(self.entries)} entries, {self.hits} hits, {self.misses} misses)"
+
+
+class SectorCache:
+    """
+    Write-back cache of image sectors, keyed by sector number in the image.
+    Reads and partial writes of a sector pull it in, whole-sector writes of
+    d-pool sectors we don't have go straight through to the image so
+    streaming data doesn't push the metadata out. I-list and i-map sectors
+    always stay in here until they're written back, so they can't reach the
+    image ahead of the data they point at. Least recently used sectors get
+    evicted (and written back if they're dirty) once we go over budget bytes.
+    The most recently used sector always stays, even with a tiny budget, so
+    the one a write is busy filling in can't vanish under it.
+    """
+    def __init__(self, image, budget):
+        self.image = image
+        self.budget = budget
+        self.ssize = image.meta._ssize
+        self.dataStart = image.meta.dPoolp // self.ssize # first d-pool sector, everything before it is metadata
+        self.sectors = OrderedDict() # sector number -> bytearray
+        self.dirty = set()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.writebacks = 0
+
+    def get(self, key):
+        """
+        Returns the cached bytearray for a sector, reading it in on a miss.
+        """
+        with self.lock:
+            sector = self.sectors.get(key)
+            if sector is not None:
+                self.hits += 1
+                self.sectors.move_to_end(key)
+                return sector
+            self.misses += 1
+            sector = bytearray(self.image.readStore(key * self.ssize, self.ssize))
+            self.sectors[key] = sector
+            self.evict()
+            return sector
+
+    def read(self, offset, size):
+        with self.lock:
+            first = offset // self.ssize
+            last = (offset + size - 1) // self.ssize
+            if first == last:
+                start = offset - first * self.ssize
+                return bytes(self.get(first)[start:start + size])
+            # bigger reads (the i-list and i-map at mount) don't get cached, we just lay cached sectors over them
+            data = bytearray(self.image.readStore(offset, size))
+            if len(self.sectors) < last - first:
+                keys = [key for key in self.sectors if first <= key <= last]
+            else:
+                keys = [key for key in range(first, last + 1) if key in self.sectors]
+            for key in keys:
+                start = max(offset, key * self.ssize)
+                end = min(offset + size, (key + 1) * self.ssize)
+                data[start - offset:end - offset] = self.sectors[key][start - key * self.ssize:end - key * self.ssize]
+            return bytes(data)
+
+    def view(self, offset, size):
+        """
+        Returns a view of a cached sector, or None if it isn't
+        cached (or the range crosses sectors) and the image is up to date.
+        """
+        with self.lock:
+            key = offset // self.ssize
+            if (offset + size - 1) // self.ssize != key:
+                if any(k in self.sectors for k in range(key, (offset + size - 1) // self.ssize + 1)):
+                    return memoryview(self.read(offset, size))
+                return None
+            sector = self.sectors.get(key)
+            if sector is None:
+                return None
+            self.hits += 1
+            start = offset - key * self.ssize
+            return memoryview(sector)[start:start + size]
+
+    def write(self, offset, data):
+        with self.lock:
+            data = memoryview(data)
+            pos = 0
+            while pos < len(data):
+                key = (offset + pos) // self.ssize
+                start = (offset + pos) % self.ssize
+                amount = min(self.ssize - start, len(data) - pos)
+                if amount == self.ssize and key not in self.sectors and key >= self.dataStart:
+                    self.image.writeStore(offset + pos, data[pos:pos + amount])
+                elif amount == self.ssize and key not in self.sectors: # whole metadata sector, no need to read it in
+                    self.sectors[key] = bytearray(data[pos:pos + amount])
+                    self.dirty.add(key)
+                else:
+                    self.get(key)[start:start + amount] = data[pos:pos + amount]
+                    self.dirty.add(key)
+                pos += amount
+            self.evict()
+
+    def overwrite(self, offset, data):
+        """
+        Called when whole sectors get written straight to the image, copies
+        data over any of them we have cached. They match the image again so
+        they aren't dirty anymore.
+        """
+        with self.lock:
+            first = offset // self.ssize
+            count = len(data) // self.ssize
+            if len(self.sectors) < count:
+                keys = [key for key in self.sectors if first <= key < first + count]
+            else:
+                keys = [key for key in range(first, first + count) if key in self.sectors]
+            for key in keys:
+                start = (key - first) * self.ssize
+                self.sectors[key][:] = data[start:start + self.ssize]
+                self.dirty.discard(key)
+
+    def evict(self):
+        with self.lock:
+            metadata = [] # dirty metadata sectors wait until the data they may point at is synced, like in sync
+            while len(self.sectors) * self.ssize > self.budget and len(self.sectors) > 1:
+                key, sector = self.sectors.popitem(last=False)
+                if key in self.dirty:
+                    self.dirty.discard(key)
+                    if key < self.dataStart:
+                        metadata.append((key, sector))
+                        continue
+                    self.writebacks += 1
+                    self.image.writeStore(key * self.ssize, sector)
+            if metadata:
+                self.flush(self.dataStart)
+                self.image.barrier()
+                for key, sector in metadata:
+                    self.writebacks += 1
+                    self.image.writeStore(key * self.ssize, sector)
+
+    def flush(self, start=0):
+        """
+        Writes the dirty sectors from sector start on back in order,
+        one write per run of neighbouring sectors.
+        """
+        with self.lock:
+            keys = sorted(key for key in self.dirty if key >= start)
+            for first, last in Image.runs(keys):
+                self.image.writeStore(first * self.ssize, b"".join(self.sectors[key] for key in range(first, last + 1)))
+                self.writebacks += 1
+            self.dirty.difference_update(keys)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "writebacks": self.writebacks,
+                "sectors": len(self.sectors), "dirty": len(self.dirty)}
+
+    def __repr__(self):
+        return " ".join(f"{k} {w}" for k,w in self.stats().items())
+
+
+class RWLock:
+    """
+    Lets any number of readers or a single writer in. Waiting writers keep
+    new readers out so they don't starve. The writer can take the lock
+    again (either side) while it holds it.
+    """
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._depth = 0
+        self._waiting = 0
+
+    @contextmanager
+    def reading(self):
+        me = threading.get_ident()
+        if self._writer == me:
+            yield
+            return
+        with self._cond:
+            while self._writer is not None or self._waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def writing(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer != me:
+                self._waiting += 1
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+                self._waiting -= 1
+                self._writer = me
+            self._depth += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._writer = None
+                    self._cond.notify_all()
+
+
+class InodeLock:
+    """
+    The RWLock of one inode, made the first time somebody takes it and
+    thrown away again once the last thread holding or waiting on it lets
+    go, so Image only keeps locks around for the inodes in use right now.
+    """
+    def __init__(self, image, inode):
+        self.image = image
+        self.inode = inode
+
+    @contextmanager
+    def reading(self):
+        lock = self._acquire()
+        try:
+            with lock.reading():
+                yield
+        finally:
+            self._release()
+
+    @contextmanager
+    def writing(self):
+        lock = self._acquire()
+        try:
+            with lock.writing():
+                yield
+        finally:
+            self._release()
+
+    def _acquire(self):
+        with self.image._inodeLocksLock:
+            entry = self.image._inodeLocks.get(self.inode)
+            if entry is None:
+                entry = self.image._inodeLocks[self.inode] = [RWLock(), 0]
+            entry[1] += 1
+            return entry[0]
+
+    def _release(self):
+        with self.image._inodeLocksLock:
+            entry = self.image._inodeLocks[self.inode]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.image._inodeLocks[self.inode]
+
+
+class Reclaimer:
+    """
+    Frees detached chains on a background thread so unlink and truncate
+    don't take longer for bigger files. Everything queued up by the time
+    the thread gets to it is freed in one batch(), so the i-map gets
+    written a sector at a time.
+    """
+    def __init__(self, image):
+        self.image = image
+        self.freed = 0
+        self.batches = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def release(self, head):
+        """
+        Queues the chain starting at head to be freed. Nothing may point at it anymore.
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="reclaimer", daemon=True)
+                self._thread.start()
+        self._queue.put(head)
+
+    def drain(self):
+        """
+        Waits until everything queued so far has been freed.
+        """
+        self._queue.join()
+
+    def close(self):
+        with self._lock:
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread.join()
+                self._thread = None
+
+    def _run(self):
+        while True:
+            heads = [self._queue.get()]
+            while True:
+                try:
+                    heads.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with self.image.batch():
+                    for head in heads:
+                        if head is not None:
+                            self.freed += self.image.freeChain(head)
+                self.batches += 1
+            finally:
+                for _ in heads:
+                    self._queue.task_done()
+            if None in heads:
+                return
+
+
+class Defragmenter:
+    """
+    Goes through the inodes in order and has relocateChain move every file
+    whose chain is split over several runs into one run. After each file it
+    sleeps long enough to stay under rate bytes a second, so it can run
+    while the image is mounted. If state is given (a file path) it records
+    the next inode there after every move, so a stopped run picks up where
+    it left off, and removes it when it gets through everything.
+    """
+    def __init__(self, image, rate=4 * 1024 * 1024, state=None):
+        self.image = image
+        self.rate = rate
+        self.state = state
+        self.files = 0
+        self.sectors = 0
+        self.skipped = 0 # fragmented files there was no free run long enough for
+        self._stop = threading.Event()
+        self._thread = None
+
+    def fragmentation(self):
+        """
+        Returns (inode, sectors, runs) for every allocated inode, a file
+        is fragmented when runs is more than 1.
+        """
+        res = []
+        for inode, node in enumerate(self.image.iNodes):
+            if node.mode != 0 and inode not in self.image._legacyLinks: # those share their target's chain
+                with self.image.inodeLock(inode).reading():
+                    chain = self.image.getChain(inode)
+                    res.append((inode, len(chain), len(self.image.runs(chain))))
+        return res
+
+    def run(self):
+        """
+        Defragments from where the state file says we left off. Returns
+        True if it got through every inode, False if it was stopped.
+        """
+        inode = self.load()
+        while inode < len(self.image.iNodes):
+            if self._stop.is_set():
+                self.save(inode)
+                return False
+            moved = self.image.relocateChain(inode) if self.image.iNodes[inode].mode != 0 else 0
+            inode += 1
+            if moved is None:
+                self.skipped += 1
+            elif moved:
+                self.files += 1
+                self.sectors += moved
+                self.save(inode)
+                if self.rate:
+                    self._stop.wait(moved * self.image.meta._ssize / self.rate)
+        if self.state is not None and os.path.exists(self.state):
+            os.unlink(self.state)
+        return True
+
+    def load(self):
+        if self.state is None or not os.path.exists(self.state):
+            return 0
+        with open(self.state) as f:
+            return int(f.read().strip() or 0)
+
+    def save(self, inode):
+        if self.state is None:
+            return
+        with open(self.state + ".tmp", "w") as f:
+            f.write(f"{inode}\n")
+        os.replace(self.state + ".tmp", self.state) # never leave a half written state file
+
+    def start(self):
+        """
+        Runs the defragmenter on a background thread.
+        """
+        self._thread = threading.Thread(target=self.run, name="defrag", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __repr__(self):
+        return f"Defragmenter(moved {self.files} files, {self.sectors} sectors, skipped {self.skipped})"
+
+
+class Readahead:
+    """
+    Watches reads coming in per stream (an open file) and once a stream
+    reads sequentially, prefetches the sectors ahead of it on a background
+    thread. The window starts at start bytes and doubles every sequential
+    read up to limit, so streaming readers end up far ahead of themselves.
+    """
+    def __init__(self, image, start=128 * 1024, limit=4 * 1024 * 1024):
+        self.image = image
+        self.start = start
+        self.limit = limit
+        self.streams = {} # key -> [next expected offset, window, prefetched up to]
+        self.prefetches = 0
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def observe(self, key, inode, off, size):
+        """
+        Called for every read of a stream, queues a prefetch when it's sequential.
+        """
+        stream = self.streams.get(key)
+        if stream is None or stream[0] != off:
+            self.streams[key] = [off + size, 0, off + size]
+            return
+        stream[0] = off + size
+        stream[1] = min(max(stream[1] * 2, self.start), self.limit)
+        if stream[2] - stream[0] < stream[1] // 2: # running out of prefetched data
+            begin = max(stream[2], stream[0])
+            stream[2] = stream[0] + stream[1]
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="readahead", daemon=True)
+                self._thread.start()
+            self._queue.put((inode, begin, stream[2] - begin))
+
+    def forget(self, key):
+        self.streams.pop(key, None)
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            try:
+                self.image.prefetch(*job)
+                self.prefetches += 1
+            except (IndexError, ValueError, OSError): # the file changed under us, it's only a hint anyway
+                pass
+
+
+class GroupCommit:
+    """
+    Lets many threads ask for commit to run while only running it once for
+    everyone who asked before it started. The first caller becomes the
+    leader, waits window seconds for others to pile on, then commits for
+    all of them (holding lock, if given, while it does). Everyone else
+    just waits for a commit that started after they asked.
+    """
+    def __init__(self, commit, window=0.002, lock=None):
+        self._commit = commit
+        self.window = window
+        self._lock = lock
+        self._cond = threading.Condition()
+        self._requested = 0
+        self._completed = 0
+        self._leading = False
+        self.requests = 0
+        self.commits = 0
+
+    def __call__(self):
+        with self._cond:
+            self._requested += 1
+            self.requests += 1
+            ticket = self._requested
+            while self._completed < ticket:
+                if not self._leading:
+                    self._leading = True
+                    break
+                self._cond.wait()
+            else:
+                return
+        try:
+            if self.window:
+                time.sleep(self.window)
+            with self._cond:
+                target = self._requested
+            if self._lock is not None:
+                with self._lock:
+                    self._commit()
+            else:
+                self._commit()
+            with self._cond:
+                self._completed = target
+                self.commits += 1
+        finally:
+            with self._cond:
+                self._leading = False
+                self._cond.notify_all()
 
 
 class MetaData:
@@ -342,7 +1809,8 @@ class INode:
         self.offset = offset
         self.lookupCount = 1
         modeBits = bread("h", data[:2])
-        self.mode = (modeBits & 0xf000) >> 12
+        self.mode = (modeBits & 0x3000) >> 12
+        self.ownsTarget = bool(modeBits & 0x4000) # a symlink keeping its target path in its own sectors
         self.s_ugt = (modeBits & 0x0E00) >> 9
         self.user = (modeBits & 0x01C0) >> 6
         self.group = (modeBits & 0x0038) >> 3
@@ -357,7 +1825,7 @@ class INode:
         self.fip = bread("i", data[28:32])
 
     def modeBits(self):
-        return (self.mode << 12) | (self.s_ugt << 9) | (self.user << 6) | (self.group << 3) | self.other
+        return (self.mode << 12) | (self.ownsTarget << 14) | (self.s_ugt << 9) | (self.user << 6) | (self.group << 3) | self.other
 
     def chmod(self, databits):
         self.s_ugt = (databits & 0x0E00)
@@ -383,17 +1851,37 @@ class FileEntry:
         return self.data.decode()
 
 
+class DirIndex:
+    """
+    In memory index of a directory file. Maps names (in bytes)
+    to (inode, slot), keeps a min-heap of the empty slots and
+    slotNames, the name in every slot (None when it's empty).
+    """
+    def __init__(self, data):
+        self.names = {}
+        self.free = []
+        self.slots = len(data) // 32
+        self.slotNames = [None] * self.slots
+        for slot in range(self.slots):
+            entry = data[slot * 32: (slot + 1) * 32]
+            name = entry[4:].split(b"\0", 1)[0]
+            if name == b"":
+                self.free.append(slot) # appended in order, so already a heap
+            else:
+                self.names[name] = (bread("i", entry[:4]), slot)
+                self.slotNames[slot] = name
+
+    def __repr__(self):
+        return f"{self.names} free {self.free}"
+
+
 class DirectoryEntry:
     """
     A directory entry that points to another inode and holds a name.
     """
     def __init__(self, data):
         self.inode = bread("i", data[0:4])
-        self.name = data[4:]
-        for i, e in enumerate(self.name):
-            if e == 0:
-                self.name = self.name[:i].decode()
-                break
+        self.name = data[4:].split(b"\0", 1)[0].decode()
 
     def __repr__(self):
         return f"({self.inode}) {self.name}"
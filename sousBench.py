@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""
+Rough timing numbers for the lardinator. Every benchmark builds its own
+throwaway image with mklardfs so it never touches ./lardfs.img.
+Run it with python3 sousBench.py [benchmark ...]
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from mklardfs import Filesystem
+from lardinator3000 import Image, GroupCommit, Readahead, WriteBuffer, Defragmenter
+
+CHUNK = 128 * 1024 # what the kernel usually asks FUSE for
+
+
+def buildImage(path, files, capacity, ifactor=0.1):
+    """
+    Builds an image at path holding files (a dict of name -> bytes) in
+    the root directory and returns it opened as an Image.
+    """
+    fs = Filesystem(capacity, ifactor)
+    for name, data in files.items():
+        fs.root.creat(name).data.extend(data)
+    with open(path, "wb+") as fd:
+        fs.dump(fd)
+    return Image(open(path, "rb+"))
+
+
+def findFile(image, name):
+    for entry in image.readDirectory(0):
+        if entry.name.encode() == name:
+            return entry.inode
+    raise KeyError(name)
+
+
+def report(label, nbytes, seconds):
+    print(f"{label:<40} {nbytes / (1024 * 1024) / seconds:10.1f} MiB/s ({seconds * 1000:.1f} ms)")
+
+
+def benchSequentialRead():
+    """
+    Reads a file front to back in kernel sized chunks the way
+    LardFS.read gets called. Throughput should stay flat as files grow.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        for mb in (1, 4, 16):
+            size = mb * 1024 * 1024
+            image = buildImage(os.path.join(tmp, f"seq{mb}.img"), {b"big": b"A" * size}, size * 2)
+            inode = findFile(image, b"big")
+            start = time.perf_counter()
+            for off in range(0, size, CHUNK):
+                image.readRange(inode, off, CHUNK)
+            report(f"sequential read {mb} MiB", size, time.perf_counter() - start)
+            image.close()
+
+
+def benchCreateStorm():
+    """
+    Creates lots of files in one directory the way LardFS.create does.
+    Every batch should take about as long as the first one.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        image = buildImage(os.path.join(tmp, "storm.img"), {b"seed": b"x"}, 16 * 1024 * 1024)
+        batch = 1000
+        for n in range(0, 5 * batch, batch):
+            start = time.perf_counter()
+            for i in range(n, n + batch):
+                inode = image.allocInode(1, 0o644)
+                image.writeDirectory(0, inode=inode, name=b"file%d" % i)
+            seconds = time.perf_counter() - start
+            print(f"create files {n:>5}-{n + batch:<5}              {batch / seconds:10.0f} files/s")
+        image.close()
+
+
+def benchFsync():
+    """
+    Has a few threads append and fsync over and over like LardFS does
+    under each --sync mode and reports the fsync latency they see.
+    """
+    threads, rounds = 8, 25
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ("strict", "batched", "relaxed"):
+            files = {b"f%d" % i: b"x" for i in range(threads)}
+            image = buildImage(os.path.join(tmp, f"{mode}.img"), files, 4 * 1024 * 1024)
+            inodes = [findFile(image, name) for name in files]
+            lock = threading.Lock() # stands in for llfuse.lock
+            committer = GroupCommit(image.sync, lock=lock)
+            latencies = []
+
+            def worker(inode):
+                for _ in range(rounds):
+                    with lock:
+                        image.writeFile(inode, image.iNodes[inode].size, b"y" * 100)
+                    start = time.perf_counter()
+                    if mode == "batched":
+                        committer()
+                    else:
+                        with lock:
+                            image.sync() if mode == "strict" else image.flush()
+                    latencies.append(time.perf_counter() - start)
+
+            workers = [threading.Thread(target=worker, args=(inode,)) for inode in inodes]
+            start = time.perf_counter()
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+            total = time.perf_counter() - start
+            latencies.sort()
+            syncs = committer.commits if mode == "batched" else (len(latencies) if mode == "strict" else 0)
+            print(f"fsync {mode:<8} mean {sum(latencies) / len(latencies) * 1000:7.2f} ms  "
+                  f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:7.2f} ms  "
+                  f"{len(latencies) / total:8.0f} fsyncs/s  {syncs} syncs")
+            image.close()
+
+
+def benchReadahead():
+    """
+    Reads a file front to back from a cold page cache with and without
+    Readahead. Each chunk sleeps a little to stand in for the trip back
+    through FUSE, which is the time the prefetch thread gets to work in.
+    Point TMPDIR at a real disk, dropping the cache does nothing on tmpfs.
+    """
+    size = 32 * 1024 * 1024
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "cold.img")
+        buildImage(path, {b"big": b"A" * size}, size * 2).close()
+        for prefetch in (False, True):
+            with open(path, "rb+") as fd:
+                os.fsync(fd.fileno())
+                os.posix_fadvise(fd.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            image = Image(open(path, "rb+"))
+            readahead = Readahead(image) if prefetch else None
+            inode = findFile(image, b"big")
+            start = time.perf_counter()
+            for off in range(0, size, CHUNK):
+                if readahead:
+                    readahead.observe(inode, inode, off, CHUNK)
+                image.readRange(inode, off, CHUNK)
+                time.sleep(0.0002)
+            report(f"cold read {'with' if prefetch else 'without'} readahead", size, time.perf_counter() - start)
+            if readahead:
+                readahead.close()
+            image.close()
+
+
+def benchAppend():
+    """
+    Appends 100 byte records to a file one at a time, first straight
+    through writeFile and then gathered up in a WriteBuffer the way
+    LardFS.write does it.
+    """
+    records, record = 20000, b"r" * 99 + b"\n"
+    with tempfile.TemporaryDirectory() as tmp:
+        for buffered in (False, True):
+            image = buildImage(os.path.join(tmp, "log.img"), {b"log": b"\n"}, 8 * 1024 * 1024)
+            inode = findFile(image, b"log")
+            buffer = WriteBuffer()
+            start = time.perf_counter()
+            for i in range(records):
+                off = i * len(record)
+                if not buffered:
+                    image.writeFile(inode, off, record)
+                elif not buffer.add(off, record):
+                    image.writeFile(inode, *buffer.take())
+                    buffer.add(off, record)
+            if buffer:
+                image.writeFile(inode, *buffer.take())
+            report(f"append 100 B records {'buffered' if buffered else 'direct'}", records * len(record),
+                   time.perf_counter() - start)
+            image.close()
+
+
+def benchReaddir():
+    """
+    Lists a 100k entry directory through LardFS.readdir the way ls -f does,
+    the kernel takes about a page of entries per call and then calls
+    readdir again from the last offset it got. Needs llfuse to import waiter.
+    """
+    try:
+        from waiter import LardFS
+    except ImportError as e:
+        print(f"readdir skipped, can't import waiter ({e})")
+        return
+    entries, perCall = 100000, 128
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "dir.img")
+        buildImage(path, {b"file%d" % i: b"x" for i in range(entries)}, 128 * 1024 * 1024,
+                   ifactor=0.55).close() # mklardfs hands out one inode per i-list sector
+        lardfs = LardFS(open(path, "rb+"))
+        fh = lardfs.opendir(1, None)
+        start = time.perf_counter()
+        seen, off, calls = 0, 0, 0
+        while True:
+            batch = []
+            for name, attr, next in lardfs.readdir(fh, off):
+                batch.append(name)
+                off = next
+                if len(batch) == perCall:
+                    break
+            calls += 1
+            seen += len(batch)
+            if not batch:
+                break
+        seconds = time.perf_counter() - start
+        print(f"readdir {seen} entries in {calls} calls        {seen / seconds:10.0f} entries/s ({seconds * 1000:.1f} ms)")
+        lardfs.releasedir(fh)
+        lardfs.destroy()
+
+
+def benchReclaim():
+    """
+    Truncates and then unlinks files of growing size. The foreground part
+    should take about as long for every size, the freeing happens on the
+    reclaimer thread (the drain column).
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        for mb in (1, 16, 64):
+            size = mb * 1024 * 1024
+            image = buildImage(os.path.join(tmp, f"free{mb}.img"), {b"a": b"a" * size, b"b": b"b" * size}, size * 3)
+            a, b = findFile(image, b"a"), findFile(image, b"b")
+            start = time.perf_counter()
+            image.truncate(a, 0)
+            truncated = time.perf_counter()
+            with image.batch():
+                image.writeDirectory(0, name=b"b", delete=True)
+                image.freeInode(b)
+                image.writeInode(b)
+            unlinked = time.perf_counter()
+            image.reclaimer.drain()
+            print(f"free {mb:>2} MiB files    truncate {(truncated - start) * 1000:7.2f} ms  "
+                  f"unlink {(unlinked - truncated) * 1000:7.2f} ms  drain {(time.perf_counter() - unlinked) * 1000:7.2f} ms")
+            image.close()
+
+
+def benchInterleave():
+    """
+    Has four writers append to their own files in turns, the way parallel
+    downloads or logs do, with and without writeFile grabbing sectors
+    ahead. Reports how many separate runs the files end up in, fewer runs
+    means longer readahead and fewer seeks on real disks.
+    """
+    writers, chunk, rounds = 4, 16 * 1024, 256
+    total = writers * chunk * rounds
+    with tempfile.TemporaryDirectory() as tmp:
+        for ahead in (False, True):
+            files = {b"w%d" % i: b"\n" for i in range(writers)}
+            image = buildImage(os.path.join(tmp, f"interleave{int(ahead)}.img"), files, total * 2)
+            inodes = [findFile(image, name) for name in files]
+            start = time.perf_counter()
+            for _ in range(rounds):
+                for inode in inodes:
+                    image.writeFile(inode, image.iNodes[inode].size, b"w" * chunk, ahead=ahead)
+            for inode in inodes:
+                image.trimPreallocation(inode)
+            image.reclaimer.drain()
+            seconds = time.perf_counter() - start
+            runs = sum(len(image.runs(image.getChain(inode))) for inode in inodes)
+            label = "with" if ahead else "without"
+            print(f"interleaved appends {label:<7} grow-ahead   {runs:6d} runs  "
+                  f"{total / (1024 * 1024) / seconds:7.1f} MiB/s ({seconds * 1000:.1f} ms)")
+            image.close()
+
+def benchLargeWrite():
+    """
+    Writes files of a few MiB through writeFile in 1 MiB calls, once
+    growing a fresh file and once overwriting it, starting off a sector
+    boundary so every call has a partial head and tail.
+    """
+    write = 1024 * 1024
+    with tempfile.TemporaryDirectory() as tmp:
+        for mb in (4, 16, 64):
+            size = mb * 1024 * 1024
+            image = buildImage(os.path.join(tmp, f"big{mb}.img"), {b"big": b"\n"}, size * 2)
+            inode = findFile(image, b"big")
+            data = b"w" * write
+            for label in ("grow", "overwrite"):
+                start = time.perf_counter()
+                for off in range(100, size, write):
+                    image.writeFile(inode, off, data)
+                image.flush()
+                report(f"{label} {mb} MiB in 1 MiB writes", size, time.perf_counter() - start)
+            image.close()
+
+
+def benchDefrag():
+    """
+    Interleaves eight files sector by sector and then defragments them
+    unthrottled, reporting the runs before and after and how fast sectors
+    got moved. Every file costs two syncs, so TMPDIR matters here too.
+    """
+    writers, chunk, rounds = 8, 4096, 256
+    with tempfile.TemporaryDirectory() as tmp:
+        files = {b"f%d" % i: b"\n" for i in range(writers)}
+        image = buildImage(os.path.join(tmp, "defrag.img"), files, writers * chunk * rounds * 3)
+        inodes = [findFile(image, name) for name in files]
+        for _ in range(rounds):
+            for inode in inodes:
+                image.writeFile(inode, image.iNodes[inode].size, b"d" * chunk)
+        defrag = Defragmenter(image, rate=0)
+        before = sum(s[2] for s in defrag.fragmentation())
+        start = time.perf_counter()
+        defrag.run()
+        image.reclaimer.drain()
+        seconds = time.perf_counter() - start
+        after = sum(s[2] for s in defrag.fragmentation())
+        moved = defrag.sectors * image.meta._ssize
+        print(f"defrag {defrag.files} files {before:6d} -> {after} runs   "
+              f"{moved / (1024 * 1024) / seconds:10.1f} MiB/s ({seconds * 1000:.1f} ms)")
+        image.close()
+
+
+BENCHMARKS = {
+    "read": benchSequentialRead,
+    "readahead": benchReadahead,
+    "create": benchCreateStorm,
+    "fsync": benchFsync,
+    "append": benchAppend,
+    "readdir": benchReaddir,
+    "reclaim": benchReclaim,
+    "interleave": benchInterleave,
+    "write": benchLargeWrite,
+    "defrag": benchDefrag,
+}
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
@@ -1,8 +1,28 @@
-from lardinator3000 import Image
+import os
+import tempfile
+import threading
+from mklardfs import Filesystem
+from lardinator3000 import Image, GroupCommit, Readahead, ChainCursor, WriteBuffer, DentryCache, Defragmenter
 
 def getImage():
     return Image(open("./lardfs.img", "rb+"))
 
+def makeImage(files, capacity=360*1024, mode="rb+"):
+    """Builds a throwaway image with files (name -> bytes) in the root directory."""
+    fs = Filesystem(capacity)
+    for name, data in files.items():
+        fs.root.creat(name).data.extend(data)
+    fd, path = tempfile.mkstemp(suffix=".img")
+    os.close(fd)
+    with open(path, "wb+") as f:
+        fs.dump(f)
+    image = Image(open(path, mode))
+    os.unlink(path)
+    return image
+
+def findFile(image, name):
+    return [e.inode for e in image.readDirectory(0) if e.name.encode() == name][0]
+
 def testRead():
     image = getImage()
     assert image.readFile(2).data.decode().strip() == "hello, world!"
@@ -35,6 +55,589 @@ def testAllocInode():
     image.writeDirectory(0, inode, b"file")
     assert image.readDirectory(0)[-1].inode == inode
     
+def testReadRange():
+    data = bytes(range(256)) * 20
+    image = makeImage({b"data": data})
+    inode = findFile(image, b"data")
+    assert image.readRange(inode, 0, len(data)) == data
+    assert image.readRange(inode, 500, 30) == data[500:530]
+    assert image.readRange(inode, 1000, 2000) == data[1000:3000]
+    assert image.readRange(inode, len(data) - 10, 100) == data[-10:]
+    assert image.readRange(inode, len(data), 100) == b""
+
+def testChainCache():
+    image = makeImage({b"a": b"a" * 2000, b"b": b"b" * 100})
+    a, b = findFile(image, b"a"), findFile(image, b"b")
+    image.chainCacheSize = 4
+    assert len(image.getImaps(a)) == 4
+    assert len(image.getImaps(b)) == 1
+    assert a not in image._chains # evicted to stay under chainCacheSize
+    image.writeFile(b, 100, b"c" * 1500)
+    assert len(image.getImaps(b)) == 4
+    assert image.readRange(b, 0, 1600) == b"b" * 100 + b"c" * 1500
+    image.truncate(a, 600)
+    assert len(image.getImaps(a)) == 2
+    image._chains.clear()
+    image._chainSectors = 0
+    assert len(image.getImaps(a)) == 2 # rebuilt from the imap, which agrees with the cache
+    assert len(image.getImaps(b)) == 4
+
+def testAllocImaps():
+    image = makeImage({b"a": b"a" * 10})
+    free = image.getNumFreeImaps()
+    assert free == image.iMap.count(-1)
+    first = image.allocImaps(3, contiguous=True)
+    assert first == list(range(first[0], first[0] + 3))
+    for imap in first:
+        image.iMap[imap] = -2
+    assert image.getNumFreeImaps() == free - 3
+    image.unallocateImap(first[1])
+    assert image.getNumFreeImaps() == free - 2
+    nxt = image.allocImap()
+    assert nxt not in first # next fit keeps going instead of refilling the hole
+    image.iMap[nxt] = -2
+    assert image.getNumFreeImaps() == image.iMap.count(-1)
+
+def testInodePool():
+    image = makeImage({b"a": b"a"})
+    free = image.getNumFreeInodes()
+    assert free == len([i for i in image.iNodes if i.mode == 0])
+    first = image.allocInode(1, 0o644)
+    second = image.allocInode(1, 0o644)
+    assert second == first + 1
+    assert image.getNumFreeInodes() == free - 2
+    image.freeInode(first)
+    image.freeInode(first) # freeing twice doesn't count twice
+    assert image.getNumFreeInodes() == free - 1
+    assert image.allocInode(2, 0o755) == first # lowest free inode gets reused
+    image.wipe(second)
+    assert image.getNumFreeInodes() == free - 1
+    assert image.getNumFreeInodes() == len([i for i in image.iNodes if i.mode == 0])
+    epochs = len(image._epochs)
+    for _ in range(100): # churning through inodes doesn't leave anything behind per inode
+        inode = image.allocInode(1, 0o644)
+        image.writeFile(inode, 0, b"x")
+        image.truncate(inode, 0)
+        image.freeInode(inode)
+    assert len(image._epochs) == epochs
+
+def testDirectoryIndex():
+    image = makeImage({b"a": b"a", b"b": b"b"})
+    a = findFile(image, b"a")
+    assert image.lookupDirectory(0, b"a") == a
+    assert image.lookupDirectory(0, b"nope") is None
+    slots = image.getDirectory(0).slots
+    image.writeDirectory(0, name=b"a", delete=True)
+    assert image.lookupDirectory(0, b"a") is None
+    image.writeDirectory(0, inode=a, name=b"c" * 28)
+    assert image.getDirectory(0).slots == slots # reused the hole a left
+    assert image.lookupDirectory(0, b"c" * 28) == a
+    image.dropDirectory(0)
+    assert image.lookupDirectory(0, b"c" * 28) == a # and it made it to disk
+    assert [e.name for e in image.readDirectory(0)].count("c" * 28) == 1
+
+def testDirectorySlots():
+    image = makeImage({b"a": b"a"})
+    a = findFile(image, b"a")
+    links = image.iNodes[0].linkCount
+    for i in range(40):
+        image.writeDirectory(0, inode=a, name=b"f%d" % i)
+    assert image.iNodes[0].linkCount == links + 40
+    for i in range(0, 40, 2):
+        image.writeDirectory(0, name=b"f%d" % i, delete=True)
+    assert image.iNodes[0].linkCount == links + 40 # deletes don't bump the parent
+    image.renameDirectory(0, b"f1", 0, b"g1")
+    assert image.lookupDirectory(0, b"g1") == a
+    names = [e.name for e in image.readDirectory(0)]
+    image.compactDirectory(0)
+    assert image.getDirectory(0).free == []
+    assert image.iNodes[0].size == len(names) * 32
+    assert [e.name for e in image.readDirectory(0)] == names
+    for i in range(60):
+        image.writeDirectory(0, inode=a, name=b"h%d" % i)
+    for i in range(55):
+        image.writeDirectory(0, name=b"h%d" % i, delete=True)
+    used = len(image.getDirectory(0).names)
+    assert not image.compactSparseDirectory(0, 2) # not twice as many empty slots as used ones
+    size = image.iNodes[0].size
+    assert image.compactSparseDirectory(0, 1)
+    assert image.iNodes[0].size == size - 55 * 32 == used * 32
+    assert image.lookupDirectory(0, b"h57") == a
+    assert not image.compactSparseDirectory(0, 1) # nothing left to squeeze out
+
+def testSectorCache():
+    image = makeImage({b"a": b"a" * 100})
+    a = findFile(image, b"a")
+    image.iNodes[a].size = 50
+    image.writeInode(a)
+    location = image.iNodes[a].offset
+    assert image.readStore(location, 32) != image.iNodes[a].toBytes() # still only in the cache
+    assert image.read(location, 32) == image.iNodes[a].toBytes()
+    assert image.cache.hits >= 1
+    image.flush()
+    assert image.readStore(location, 32) == image.iNodes[a].toBytes()
+    assert not image.cache.dirty
+    image.cache.budget = 2 * image.meta._ssize
+    for i in range(5):
+        image.write(image.meta.dPoolp + (10 + i) * image.meta._ssize, b"z")
+    assert len(image.cache.sectors) == 2 # evicted the rest and wrote them back
+    assert image.readStore(image.meta.dPoolp + 10 * image.meta._ssize, 1) == b"z"
+    image = makeImage({b"a": b"a" * 100})
+    a = findFile(image, b"a")
+    events = []
+    writeStore, barrier = image.writeStore, image.barrier
+    image.writeStore = lambda offset, data: events.append("data" if offset >= image.meta.dPoolp else "meta") or writeStore(offset, data)
+    image.barrier = lambda: events.append("barrier") or barrier()
+    with image.batch():
+        image.writeFile(a, 100, b"b" * 10)
+    assert "meta" not in events # the inode waits in the cache for sync
+    image.sync()
+    assert events.index("barrier") < events.index("meta") and events.index("data") < events.index("barrier")
+    events.clear()
+    image.writeInode(a)
+    image.cache.budget = 0 # evicting metadata syncs the data ahead of it too
+    image.write(image.meta.dPoolp, b"c")
+    assert events[-2:] == ["barrier", "meta"]
+    image.flush()
+    assert image.readStore(image.meta.dPoolp, 1) == b"c" # the sector being written didn't get evicted under it
+    image.cache.budget = 100 # less than a sector
+    image.write(image.meta.dPoolp + 122 * image.meta._ssize + 3, b"d")
+    image.write(image.meta.dPoolp + 123 * image.meta._ssize, b"e")
+    image.flush()
+    assert not image.cache.dirty and len(image.cache.sectors) == 1
+    assert image.readStore(image.meta.dPoolp + 122 * image.meta._ssize + 3, 1) == b"d"
+    assert image.readStore(image.meta.dPoolp + 123 * image.meta._ssize, 1) == b"e"
+
+def testMetadataBatch():
+    image = makeImage({b"big": b"b" * 40000})
+    big = findFile(image, b"big")
+    free = image.getNumFreeImaps()
+    writes = []
+    write = image.write
+    image.write = lambda offset, data: writes.append(offset) or write(offset, data)
+    image.truncate(big, 100)
+    image.reclaimer.drain()
+    assert image.getNumFreeImaps() == free + 78
+    assert len(writes) <= 4 # one imap sector, one inode sector, the zeroed tail and the reclaimer's imap sector
+    image.write = write
+    with image.batch():
+        image.iNodes[big].size = 10
+        image.writeInode(big)
+        assert image.read(image.iNodes[big].offset, 32) != image.iNodes[big].toBytes()
+    assert image.read(image.iNodes[big].offset, 32) == image.iNodes[big].toBytes()
+    assert image.iMap == image.readIMap() # what made it to disk matches memory
+
+def testGroupCommit():
+    image = makeImage({b"a": b"a"})
+    a = findFile(image, b"a")
+    image.writeFile(a, 1, b"bc")
+    syncs = []
+    committer = GroupCommit(lambda: syncs.append(image.sync()), window=0.05)
+    callers = [threading.Thread(target=committer) for _ in range(8)]
+    for caller in callers:
+        caller.start()
+    for caller in callers:
+        caller.join()
+    assert committer.requests == 8
+    assert 1 <= len(syncs) < 8
+    assert not image.cache.dirty
+    assert image.readStore(image.meta.dPoolp + image.getChain(a)[0] * image.meta._ssize, 3) == b"abc"
+
+def testConcurrentStress():
+    files = {b"r%d" % i: bytes([65 + i]) * (3000 + 100 * i) for i in range(4)}
+    files.update({b"w%d" % i: b"w" for i in range(4)})
+    image = makeImage(files, capacity=1024*1024)
+    readers = {findFile(image, name): data for name, data in files.items() if name.startswith(b"r")}
+    writers = [findFile(image, name) for name in files if name.startswith(b"w")]
+    errors = []
+
+    def read(inode, data):
+        for i in range(200):
+            off = (i * 97) % len(data)
+            if image.readRange(inode, off, 700) != data[off:off + 700]:
+                errors.append(inode)
+
+    def write(inode, n):
+        for i in range(55):
+            image.writeFile(inode, image.iNodes[inode].size, b"%d," % i)
+            if i % 10 == 9:
+                image.truncate(inode, 1)
+        child = image.allocInode(1, 0o644)
+        image.writeDirectory(0, inode=child, name=b"new%d" % n)
+
+    threads = [threading.Thread(target=read, args=item) for item in readers.items()]
+    threads += [threading.Thread(target=write, args=(inode, n)) for n, inode in enumerate(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    for n, inode in enumerate(writers):
+        assert image.readRange(inode, 0, 100) == b"w" + b"".join(b"%d," % i for i in range(50, 55))
+        assert image.lookupDirectory(0, b"new%d" % n) is not None
+    assert image.getNumFreeImaps() == image.iMap.count(-1)
+    assert image.getNumFreeInodes() == len([i for i in image.iNodes if i.mode == 0])
+    assert image._inodeLocks == {} # locks only live while somebody holds them
+
+def testReadahead():
+    image = makeImage({b"big": bytes(range(256)) * 2048}, capacity=1024 * 1024)
+    inode = findFile(image, b"big")
+    readahead = Readahead(image, start=4096, limit=16384)
+    readahead.observe(1, inode, 0, 1024)
+    assert readahead._thread is None # one read isn't a stream yet
+    for off in range(1024, 8192, 1024):
+        readahead.observe(1, inode, off, 1024)
+    assert readahead.streams[1][1] == 16384
+    assert readahead.streams[1][2] >= 8192
+    readahead.observe(1, inode, 0, 1024) # seeking resets the window
+    assert readahead.streams[1][1] == 0
+    readahead.observe(2, inode, 0, 1024)
+    readahead.forget(2)
+    assert 2 not in readahead.streams
+    readahead.close()
+    assert readahead.prefetches > 0
+    assert image.readRange(inode, 1000, 10) == (bytes(range(256)) * 2048)[1000:1010]
+    done = threading.Event()
+    with image.inodeLock(inode).writing(): # a truncate in progress
+        worker = threading.Thread(target=lambda: image.prefetch(inode, 0, 65536) or done.set())
+        worker.start()
+        assert not done.wait(0.05) # the prefetch waits for it
+    worker.join()
+    assert done.is_set()
+
+def testChainCursor():
+    a, b = bytes(range(256)) * 64, b"b" * 4096
+    image = makeImage({b"a": a, b"b": b})
+    inodeA, inodeB = findFile(image, b"a"), findFile(image, b"b")
+    image.chainCacheSize = 1 # only the last chain used stays cached
+    cursor = ChainCursor()
+    for off in range(0, len(a), 1000):
+        assert image.readRange(inodeA, off, 1000, cursor) == a[off:off + 1000]
+        image.readRange(inodeB, 0, 10) # evicts a's chain, so the cursor does the walking
+        assert inodeA not in image._chains
+    assert cursor.sector == image.getChain(inodeA)[cursor.index]
+    image.writeFile(inodeB, 0, b"c")
+    image.truncate(inodeA, 100) # chain shrank, the cursor is stale now
+    image.writeFile(inodeA, 100, b"new" * 2000, cursor)
+    image.readRange(inodeB, 0, 10)
+    assert image.readRange(inodeA, 5000, 10, cursor) == (a[:100] + b"new" * 2000)[5000:5010]
+    data = image.readFile(inodeA).data
+    errors = []
+
+    def reader(step): # two readers of one handle at different places, like async readahead with --workers
+        for off in range(0, len(data), step):
+            if image.readRange(inodeA, off, 500, cursor) != data[off:off + 500]:
+                errors.append(off)
+            image.readRange(inodeB, 0, 10)
+
+    threads = [threading.Thread(target=reader, args=(step,)) for step in (700, 1300)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+
+def testWriteBuffer():
+    buffer = WriteBuffer(limit=100)
+    assert buffer.add(10, b"abc") and buffer.add(13, b"def")
+    assert buffer.add(11, b"XY") # overwriting buffered data is fine too
+    assert not buffer.add(30, b"gap") # not adjacent
+    assert not buffer.add(16, b"z" * 95) # would overflow the limit
+    assert buffer.end() == 16
+    assert buffer.take() == (10, b"aXYdef")
+    assert len(buffer) == 0
+    assert not buffer.add(0, b"z" * 100) # big writes don't get buffered at all
+
+def testListDirectory():
+    image = makeImage({b"seed": b"x"})
+    for i in range(20):
+        image.writeDirectory(0, inode=image.allocInode(1, 0o644), name=b"f%d" % i)
+    everything = image.listDirectory(0)
+    first = image.listDirectory(0, 0, 8)
+    assert first == everything[:8]
+    image.writeDirectory(0, name=b"f0", delete=True) # already handed out, so the next page doesn't move
+    image.writeDirectory(0, name=first[-1][1], delete=True)
+    rest = []
+    off = first[-1][0] + 1
+    while page := image.listDirectory(0, off, 8):
+        rest += page
+        off = page[-1][0] + 1
+    assert rest == everything[8:]
+    image.renameDirectory(0, b"f19", 0, b"g19")
+    assert image.listDirectory(0, rest[-1][0])[0][1] == b"g19"
+
+def testSymlinks():
+    image = makeImage({b"target": b"data"})
+    target = findFile(image, b"target")
+    link = image.allocInode(3, 0o777)
+    image.writeLink(link, b"../some/where/target")
+    assert image.readLink(link) == b"../some/where/target"
+    assert image.iNodes[link].fip != image.iNodes[target].fip
+    old = image.allocInode(3, 0o777) # the way softLinkInode used to make them
+    image.iNodes[old].fip = image.iNodes[target].fip
+    image.iNodes[old].size = image.iNodes[target].size
+    assert image.findLegacyLinks() == {old}
+    image._legacyLinks = image.findLegacyLinks()
+    assert image.readLink(old) is None
+    image.freeInode(old)
+    assert image._legacyLinks == set()
+    old = image.allocInode(3, 0o777)
+    image.iNodes[old].fip = image.iNodes[target].fip
+    image.iNodes[old].size = image.iNodes[target].size
+    image._legacyLinks = {old}
+    free = image.getNumFreeImaps()
+    image.freeInode(target) # the target is gone, the link is marked dangling
+    image.reclaimer.drain()
+    assert image.iNodes[old].fip == -1 and image.getNumFreeImaps() == free + 1
+    assert image.findLegacyLinks() == {old} # so readlink still says ENOLINK
+    assert image.allocInode(1, 0o644) == target # even once the target's inode is reused
+    assert image.findLegacyLinks() == {old}
+    spare = [e for e, i in enumerate(image.iNodes) if i.mode == 0][0]
+    image.iNodes[spare].fip = image.iNodes[link].fip # a freed inode's stale fip the new link got handed
+    image.iNodes[spare].size = 3000
+    assert image.findLegacyLinks() == {old}
+    older = image.allocInode(3, 0o777) # target deleted by an older lardinator, its inode still says so
+    image.iNodes[older].size = 3000
+    image.iNodes[older].fip = image.allocImap()
+    image.iMap[image.iNodes[older].fip] = -2
+    dead = [e for e, i in enumerate(image.iNodes) if i.mode == 0 and e != spare][0]
+    image.iNodes[dead].fip, image.iNodes[dead].size = image.iNodes[older].fip, 3000
+    assert image.findLegacyLinks() == {old, older}
+    image._legacyLinks.add(older)
+    dangling = image.allocInode(3, 0o777)
+    image.unallocateImap(image.iNodes[dangling].fip) # an old link whose target's sectors got freed
+    assert dangling in image.findLegacyLinks()
+
+def testSymlinkRemount():
+    fs = Filesystem(360*1024)
+    fs.root.creat(b"note").data.extend(b"spare")
+    fd, path = tempfile.mkstemp(suffix=".img")
+    os.close(fd)
+    with open(path, "wb+") as f:
+        fs.dump(f)
+    image = Image(open(path, "rb+"))
+    note = findFile(image, b"note")
+    image.writeFile(note, 0, b"6bytes")
+    fip = image.iNodes[note].fip
+    image.writeDirectory(0, name=b"note", delete=True)
+    image.freeInode(note)
+    image.writeInode(note)
+    image.reclaimer.drain()
+    assert image.iNodes[note].fip == -1 and image.iNodes[note].size == 0
+    image._nextImap = fip # the next-fit cursor wrapped around onto the note's old sector
+    link = image.allocInode(3, 0o777)
+    image.writeLink(link, b"../etc")
+    assert image.iNodes[link].fip == fip
+    stale = [e for e, i in enumerate(image.iNodes) if i.mode == 0][0]
+    image.iNodes[stale].fip, image.iNodes[stale].size = fip, 6 # freed by an older lardinator
+    image.writeInode(stale)
+    old = image.allocInode(3, 0o777) # made before ownsTarget, but holds a path of its own
+    image.writeFile(old, 0, b"/tmp")
+    image.close()
+    image = Image(open(path, "rb+"))
+    assert image._legacyLinks == set()
+    assert image.readLink(link) == b"../etc"
+    assert image.iNodes[old].ownsTarget # worked out once and written back
+    image.close()
+    image = Image(open(path, "rb"))
+    assert image.iNodes[old].ownsTarget and image.readLink(old) == b"/tmp"
+    image.close()
+    os.unlink(path)
+
+def testReadOnlyWarm():
+    image = makeImage({b"a": b"a" * 3000, b"b": b"b"}, mode="rb")
+    assert not image.writable
+    image.warm()
+    live = [e for e, i in enumerate(image.iNodes) if i.mode != 0]
+    assert sorted(image._chains) == live
+    assert list(image._dirs) == [0]
+    assert image.readRange(findFile(image, b"a"), 2990, 100) == b"a" * 10
+    image.close() # nothing to write back, so this mustn't try
+
+def testDentryCache():
+    cache = DentryCache(size=3)
+    assert cache.get(0, b"a") == (False, None)
+    cache.put(0, b"a", 5)
+    cache.put(0, b"missing", None)
+    assert cache.get(0, b"a") == (True, 5)
+    assert cache.get(0, b"missing") == (True, None) # misses get cached too
+    cache.put(7, b"x", 8)
+    cache.put(7, b"y", 9) # pushes out (0, b"a"), the least recently used
+    assert cache.get(0, b"a") == (False, None)
+    cache.dropParent(7)
+    assert cache.get(7, b"x") == (False, None) and 7 not in cache.parents
+    cache.drop(0, b"missing")
+    assert cache.entries == {} and cache.parents == {}
+
+def testSweepOrphans():
+    image = makeImage({b"a": b"a", b"b": b"b"})
+    a = findFile(image, b"a")
+    image.writeDirectory(0, name=b"a", delete=True)
+    image.iNodes[a].linkCount = 0 # unlinked while open, then we crashed
+    image.writeInode(a)
+    free = image.getNumFreeInodes()
+    assert image.sweepOrphans() == [a]
+    assert image.iNodes[a].mode == 0 and image.getNumFreeInodes() == free + 1
+    assert image.sweepOrphans() == []
+
+def testReclaimer():
+    image = makeImage({b"big": b"b" * 60000, b"small": b"s"})
+    big, small = findFile(image, b"big"), findFile(image, b"small")
+    free = image.getNumFreeImaps()
+    image.writeDirectory(0, name=b"big", delete=True)
+    image.freeInode(big) # returns right away, the chain gets freed in the background
+    image.writeInode(big)
+    image.truncate(small, 0)
+    image.reclaimer.drain()
+    assert image.getNumFreeImaps() == free + 118 == image.iMap.count(-1)
+    assert image.reclaimer.freed == 118
+    leaked = image.allocImaps(3) # allocated but nothing points at them, like after a crash
+    for imap in leaked:
+        image.iMap[imap] = -2
+    assert image.sweepSectors() == 3
+    assert image.getNumFreeImaps() == free + 118
+    image.close()
+    image = makeImage({b"big": b"".join(bytes([i]) * 512 for i in range(100))})
+    big = findFile(image, b"big")
+    chain = list(image.getChain(big))
+    image.dropChain(big) # cold, detachTail only walks to the sector it keeps
+    image.truncate(big, 512 * 10 + 5)
+    image.reclaimer.drain()
+    assert big not in image._chains
+    assert image.getChain(big) == chain[:11]
+    assert all(image.iMap[imap] == -1 for imap in chain[11:])
+    assert image.readRange(big, 512 * 9, 517) == b"\x09" * 512 + b"\x0a" * 5
+    image.truncate(big, 512 * 20) # growing past the chain leaves a hole
+    image.truncate(big, 512 * 15)
+    assert image.getChain(big) == chain[:11]
+    image.close()
+
+def testSparseFiles():
+    image = makeImage({b"f": b"head"})
+    f = findFile(image, b"f")
+    free = image.getNumFreeImaps()
+    image.truncate(f, 100000) # growing leaves a hole, nothing gets allocated
+    assert image.getNumFreeImaps() == free
+    assert image.readRange(f, 0, 6) == b"head\0\0"
+    assert image.readRange(f, 99990, 100) == bytes(10)
+    assert image.readFile(f).data == b"head" + bytes(99996)
+    zeroed = []
+    write = image.write
+    image.write = lambda offset, data: (zeroed.append(len(data)) if not any(data) else None) or write(offset, data)
+    image.writeFile(f, 5000, b"x" * 1024) # past the chain, the sectors in between get zeroed
+    image.write = write
+    assert zeroed == [8 * image.meta._ssize] # the hole only, not the sectors we wrote over
+    assert image.iNodes[f].size == 100000
+    assert image.readRange(f, 4990, 20) == bytes(10) + b"x" * 10
+    assert image.readRange(f, 6020, 10) == b"xxxx" + bytes(6)
+    image.writeFile(f, 200000, b"end") # and past the end of the file
+    assert image.iNodes[f].size == 200003
+    assert image.readRange(f, 199998, 10) == b"\0\0end"
+
+def testPreallocate():
+    image = makeImage({b"f": b"head", b"g": b"g"})
+    f, g = findFile(image, b"f"), findFile(image, b"g")
+    ssize = image.meta._ssize
+    image.preallocate(f, 0, 10 * ssize, keepSize=True)
+    chain = image.getChain(f)
+    assert len(chain) == 10 and image.iNodes[f].size == 4
+    assert chain[1:] == list(range(chain[1], chain[1] + 9)) # one contiguous run
+    assert image.readRange(f, 0, 100) == b"head"
+    image.preallocate(f, 0, 12 * ssize)
+    assert len(image.getChain(f)) == 12 and image.iNodes[f].size == 12 * ssize
+    assert image.readFile(f).data == b"head" + bytes(12 * ssize - 4)
+    image.trimPreallocation(f) # asked for explicitly, so it stays
+    assert len(image.getChain(f)) == 12
+    free = image.getNumFreeImaps()
+    for i in range(20): # an appending writer gets sectors ahead, in growing extents
+        image.writeFile(g, image.iNodes[g].size, b"x" * ssize, ahead=True)
+    assert len(image.getChain(g)) > 21
+    image.trimPreallocation(g)
+    image.reclaimer.drain()
+    assert len(image.getChain(g)) == 21
+    assert image.getNumFreeImaps() == free - 20
+    assert image.readFile(g).data == b"g" + b"x" * 20 * ssize
+    assert g not in image._extents
+    image = makeImage({b"h": b"h"})
+    h = findFile(image, b"h")
+    for sector, value in enumerate(image.iMap): # leftovers of deleted files in every free sector
+        if value == -1:
+            image.write(image.meta.dPoolp + sector * ssize, b"\xff" * ssize)
+    zeroed = []
+    zeroImaps = image.zeroImaps
+    image.zeroImaps = lambda imaps: zeroed.extend(imaps) or zeroImaps(imaps)
+    image.writeFile(h, 1, b"y" * (ssize - 1), ahead=True)
+    image.writeFile(h, ssize, b"z" * 10, ahead=True) # lands in a sector grabbed ahead
+    assert len(image.getChain(h)) > 2 and zeroed == [] # nothing got zeroed for the sectors grabbed ahead
+    assert image.readRange(h, 0, 3 * ssize) == b"h" + b"y" * (ssize - 1) + b"z" * 10
+    image.writeFile(h, 3 * ssize, b"w", ahead=True) # skips a sector grabbed ahead, which now reads as zeroes
+    assert image.readRange(h, ssize, 3 * ssize) == b"z" * 10 + bytes(2 * ssize - 10) + b"w"
+    image.truncate(h, 5 * ssize) # so does growing over them
+    assert image.readRange(h, 3 * ssize, 2 * ssize) == b"w" + bytes(2 * ssize - 1)
+    image.preallocate(h, 0, 7 * ssize)
+    assert image.readRange(h, 5 * ssize, 2 * ssize) == bytes(2 * ssize)
+
+def testVectoredWrite():
+    for mapped in (True, False):
+        image = makeImage({b"a": b"a", b"b": b"b"})
+        a, b = findFile(image, b"a"), findFile(image, b"b")
+        if not mapped:
+            image._store = None # pretend the mmap failed so writes go through pwritev
+        ssize = image.meta._ssize
+        for i in range(6): # interleave the two chains so a write covers several runs
+            image.writeFile(a, image.iNodes[a].size, b"a" * ssize)
+            image.writeFile(b, image.iNodes[b].size, b"b" * 3 * ssize)
+        assert len(image.runs(image.getChain(a))) > 1
+        model = bytearray(image.readFile(a).data)
+        image.readSector(image.getChain(a)[2]) # cached, so the write below has to refresh it
+        writes = []
+        write = image.write
+        image.write = lambda offset, data: writes.append(len(data)) or write(offset, data)
+        for off, size in ((100, 4 * ssize), (ssize, 2 * ssize), (3, ssize - 6), (5 * ssize - 7, 3 * ssize)):
+            data = os.urandom(size)
+            image.writeFile(a, off, data)
+            model[off:off + size] = data
+        image.write = write
+        assert max(writes) == ssize # only ever partial sectors go through the cache
+        image.flush()
+        assert image.readFile(a).data == bytes(model)
+        assert image.readFile(b).data == b"b" + b"b" * 18 * ssize
+
+def testDefragment():
+    image = makeImage({b"a": b"a", b"b": b"b", b"c": b"c"})
+    a, b, c = findFile(image, b"a"), findFile(image, b"b"), findFile(image, b"c")
+    ssize = image.meta._ssize
+    for i in range(8): # interleave the chains
+        for inode in (a, b, c):
+            image.writeFile(inode, image.iNodes[inode].size, bytes([65 + i]) * ssize)
+    data = {inode: image.readFile(inode).data for inode in (a, b, c)}
+    old = image.getChain(a)[0]
+    fd, state = tempfile.mkstemp()
+    os.close(fd)
+    defrag = Defragmenter(image, rate=0, state=state)
+    assert {s[0]: s[2] for s in defrag.fragmentation()}[a] > 1
+    defrag.save(b) # as if a run got stopped after a
+    assert defrag.run()
+    assert not os.path.exists(state) # done, so it forgets where it was
+    assert len(image.runs(image.getChain(a))) > 1 # skipped, the state said we were past it
+    assert all(len(image.runs(image.getChain(inode))) == 1 for inode in (b, c))
+    assert defrag.files == 2 and defrag.sectors == 18
+    free = image.getNumFreeImaps()
+    assert image.relocateChain(a) == 9
+    assert image.relocateChain(a) == 0 # one run already
+    image.reclaimer.drain()
+    assert image.getNumFreeImaps() == free # the old chain went back
+    assert image.iMap[old] == -1
+    for inode in (a, b, c):
+        assert image.readFile(inode).data == data[inode]
+    image.close()
+    image = makeImage({b"big": b"x" * 100000}, capacity=128 * 1024)
+    big = findFile(image, b"big")
+    image.writeFile(big, 0, b"y") # shuffle the chain so it isn't one run
+    chain = image.getChain(big)
+    chain[1], chain[2] = chain[2], chain[1]
+    image.iMap[chain[0]], image.iMap[chain[1]], image.iMap[chain[2]] = chain[1], chain[2], chain[3]
+    assert image.relocateChain(big) is None # no free run long enough
 
 if __name__ == "__main__":
     testAllocInode()
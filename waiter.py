@@ -5,7 +5,7 @@ import logging
 import sys
 import os
 import stat
-from typing import BinaryIO
+from typing import BinaryIO, Optional
 import errno
 
 import llfuse
@@ -16,10 +16,96 @@ faulthandler.enable()
 
 log = logging.getLogger(__name__)
 
+class Handle:
+    """
+    What LardFS remembers about one open file or directory between calls.
+    """
+    def __init__(self, inode, flags):
+        self.inode = inode # Image inode, so already 0-based
+        self.flags = flags
+        self.cursor = ChainCursor()
+        self.buffer = WriteBuffer()
+
+    def __repr__(self):
+        return f"Handle(inode={self.inode}, flags={self.flags:#o}, cursor={self.cursor}, buffer={self.buffer})"
+
+
 class LardFS(llfuse.Operations):
-    def __init__(self, image_file: BinaryIO):
+    def __init__(self, image_file: BinaryIO, cache_size: int = 8 << 20, sync_mode: str = "batched",
+                 readahead: bool = True, attr_timeout: float = 1, entry_timeout: float = 1, keep_cache: bool = True,
+                 read_only: bool = False, negative_timeout: float = 1, sweep: bool = False,
+                 defrag: Optional[int] = None, defrag_state: Optional[str] = None, compact_ratio: float = 1):
         super().__init__()
-        self.image = Image(image_file)
+        self.image = Image(image_file, cacheSize=cache_size)
+        self.sync_mode = sync_mode
+        self.attr_timeout = attr_timeout
+        self.entry_timeout = entry_timeout
+        self.keep_cache = keep_cache
+        self.negative_timeout = negative_timeout
+        self.compact_ratio = compact_ratio # empty directory slots per used one that get a directory compacted, 0 for never
+        self.dentries = DentryCache() # (parent, name) -> inode or None, both in Image numbering
+        self.committer = GroupCommit(self.image.sync, lock=llfuse.lock)
+        self.readahead = Readahead(self.image) if readahead else None
+        self.handles = {} # fh -> Handle
+        self.nextHandle = 1
+        self.buffered = {} # inode -> set of fhs with buffered writes to it
+        self.read_only = read_only
+        self.orphans = set() # inodes with no links left that the kernel still holds, freed on their last forget
+        for node in self.image.iNodes:
+            node.lookupCount = 0 # the kernel hasn't looked anything up yet, and this count only lives in memory
+        if not read_only:
+            for inode in self.image.sweepOrphans(): # left behind by a crash while they were still open
+                log.info(f"reclaimed orphaned inode {inode + 1}")
+            if sweep:
+                log.info(f"reclaimed {self.image.sweepSectors()} leaked sectors")
+        self.attrs = {} # llfuse inode -> EntryAttributes, only filled in read-only mode
+        if read_only: # nothing can change, so build every index once now and never look at the disk for metadata again
+            self.image.warm()
+            for inode, node in enumerate(self.image.iNodes):
+                if node.mode != 0:
+                    self.attrs[inode + 1] = self.getattr(inode + 1)
+        self.defrag = None
+        if defrag is not None and not read_only: # defrag is the rate in bytes a second, 0 for unthrottled
+            self.defrag = Defragmenter(self.image, rate=defrag, state=defrag_state)
+            self.defrag.start()
+
+    def checkWritable(self):
+        """
+        Raises EROFS for anything that would change a --read-only mount.
+        """
+        if self.read_only:
+            raise llfuse.FUSEError(errno.EROFS)
+
+    def commit(self):
+        """
+        Makes the image durable the way sync_mode says to. strict syncs
+        right away, batched shares one sync between every fsync that shows
+        up within the group commit window, and relaxed only writes back
+        the cache and leaves the rest to the OS.
+        """
+        if self.read_only:
+            return
+        if self.sync_mode == "strict":
+            self.image.sync()
+        elif self.sync_mode == "batched":
+            with llfuse.lock_released:
+                self.committer()
+        else:
+            self.image.flush()
+
+    def invalidateInode(self, inode, attr_only=True):
+        """
+        Tells the kernel to forget what it cached about inode (llfuse numbering). With
+        long --attr-timeout values this is what keeps getattr results honest.
+        llfuse queues these and sends them from its own thread, so it's fine under the lock.
+        """
+        llfuse.invalidate_inode(inode, attr_only)
+
+    def invalidateEntry(self, parent_inode, name):
+        """
+        Same thing for the lookup of name in parent_inode, for --entry-timeout.
+        """
+        llfuse.invalidate_entry(parent_inode, name)
     
 #   def access(self, inode, mode, ctx):
 #       log.debug("access")
@@ -27,34 +113,105 @@ class LardFS(llfuse.Operations):
 
     def create(self, parent_inode, name, mode, flags, ctx):
         log.debug("create")
-        ninode = self.image.allocInode(1, mode)
-        self.image.writeDirectory(parent_inode - 1, inode=ninode, name=name)
-        return (ninode + 1, self.getattr(ninode + 1)) # We don't explicity increment lookupCount here because it's set in class INode
+        self.checkWritable()
+        with self.image.batch():
+            ninode = self.image.allocInode(1, mode)
+            self.image.writeDirectory(parent_inode - 1, inode=ninode, name=name)
+            self.dentries.put(parent_inode - 1, name, ninode)
+            self.image.iNodes[ninode].lookupCount = 1 # returning the entry counts as a lookup
+            return (self.openHandle(ninode + 1, flags), self.getattr(ninode + 1))
 
     def destroy(self):
-        self.image.image_file.close()
+        log.debug(f"sector cache {self.image.cache}")
+        log.debug(f"dentry cache {self.dentries}")
+        log.debug(f"reclaimer freed {self.image.reclaimer.freed} sectors in {self.image.reclaimer.batches} batches")
+        if self.readahead:
+            self.readahead.close()
+        if self.defrag:
+            self.defrag.close()
+            log.debug(f"{self.defrag}")
+        for inode in list(self.buffered):
+            self.flushWrites(inode)
+        for inode in list(self.orphans): # the kernel lets go of everything at unmount
+            self.reclaim(inode)
+        self.image.close()
 
     def flush(self, fh):
+        """
+        Called on every close(2), so it only empties fh's write buffer. The
+        i-list and i-map stay in the sector cache until commit, eviction or
+        destroy, which write them back after the data they point at.
+        """
         log.debug(f"flush {fh}")
+        self.flushHandle(fh)
+
+    def flushHandle(self, fh):
+        """
+        Writes out whatever fh has sitting in its write buffer in one writeFile.
+        """
+        handle = self.handles[fh]
+        if not handle.buffer:
+            return
+        self.buffered[handle.inode].discard(fh)
+        if not self.buffered[handle.inode]:
+            del self.buffered[handle.inode]
+        off, data = handle.buffer.take()
+        self.writeThrough(handle, off, data)
+
+    def writeThrough(self, handle, off, data):
+        """
+        Hands a write to Image, and if it grew the file lets the kernel know
+        the size it has cached is stale (once per buffer, not per write).
+        """
+        size = self.image.iNodes[handle.inode].size
+        with self.image.batch():
+            self.image.writeFile(handle.inode, off, data, handle.cursor, ahead=True)
+        if self.image.iNodes[handle.inode].size != size:
+            self.invalidateInode(handle.inode + 1)
+
+    def flushWrites(self, inode, skip=None):
+        """
+        Flushes every handle that has buffered writes to inode (Image numbering),
+        used before anything looks at the file's size or data.
+        """
+        for fh in list(self.buffered.get(inode, ())):
+            if fh != skip:
+                self.flushHandle(fh)
         
     def forget(self, inode_list):
+        """
+        lookupCount isn't part of the on disk inode, so this is all in memory
+        unless it lets go of the last reference to an unlinked inode.
+        """
         log.debug("forget")
         for inode, nlookup in inode_list:
-            if self.image.iNodes[inode - 1].lookupCount > nlookup:
-                self.image.iNodes[inode - 1].lookupCount -= nlookup
-            elif self.image.iNodes[inode - 1].linkCount == 0: # lookupCount would've been set to zero since lookupCount was <= to nlookup
-                self.image.iNodes[inode - 1].mode = 0
-            else:
-                self.image.iNodes[inode - 1].lookupCount = 0
-            self.image.writeInode(inode - 1)
+            node = self.image.iNodes[inode - 1]
+            node.lookupCount = max(node.lookupCount - nlookup, 0)
+            if node.lookupCount == 0 and node.linkCount <= 0 and inode - 1 in self.orphans:
+                self.reclaim(inode - 1)
+
+    def reclaim(self, inode):
+        """
+        Frees an orphan (Image numbering) now that nobody has it looked up or open.
+        """
+        self.orphans.discard(inode)
+        with self.image.batch():
+            self.image.freeInode(inode)
+            self.image.writeInode(inode)
 
     def fsync(self, fh, datasync):
         log.debug(f"fsync")
+        self.flushHandle(fh)
+        self.commit()
 
     def fsyncdir(self, fh, datasync):
         log.debug("fsyncdir")
+        self.commit()
 
     def getattr(self, inode, ctx=None):
+        if inode in self.attrs:
+            return self.attrs[inode]
+        self.flushWrites(inode - 1)
         inodeEntry = self.image.iNodes[inode - 1]
         entry = llfuse.EntryAttributes()
         entry.st_ino = inode
@@ -67,8 +224,8 @@ class LardFS(llfuse.Operations):
         entry.st_blksize = self.image.meta._ssize
         entry.st_blocks = inodeEntry.size // self.image.meta._ssize
         entry.generation = 0
-        entry.attr_timeout = 1
-        entry.entry_timeout = 1
+        entry.attr_timeout = self.attr_timeout
+        entry.entry_timeout = self.entry_timeout
         entry.st_atime_ns = inodeEntry.aTime
         entry.st_ctime_ns = inodeEntry.cTime 
         entry.st_mtime_ns = inodeEntry.mTime
@@ -83,56 +240,112 @@ class LardFS(llfuse.Operations):
         Creates a hard link to an inode
         """
         log.debug("link")
-        self.image.writeDirectory(parent_inode=targetInodeDir - 1, inode=targetInode - 1, name=new_name)
-        self.image.iNodes[targetInode - 1].linkCount += 1
-        self.image.iNodes[targetInode - 1].lookupCount += 1
-        return self.getattr(targetInode, ctx)
+        self.checkWritable()
+        with self.image.batch():
+            self.image.writeDirectory(parent_inode=targetInodeDir - 1, inode=targetInode - 1, name=new_name)
+            self.dentries.put(targetInodeDir - 1, new_name, targetInode - 1)
+            self.image.iNodes[targetInode - 1].linkCount += 1
+            self.image.iNodes[targetInode - 1].lookupCount += 1
+            return self.getattr(targetInode, ctx)
 
 #   def listxattr(self, inode, ctx):
 #       log.debug("listxattr")
 
     def lookup(self, parent_inode, name, ctx):
         log.debug(f"lookup {name} {parent_inode}")
-        directories = self.image.readDirectory(parent_inode - 1)
-        for dir in directories:
-            if dir.name.encode() == name:
-                self.image.iNodes[dir.inode].lookupCount += 1
-                self.image.writeInode(dir.inode)
-                return self.getattr(dir.inode + 1)
-        raise llfuse.FUSEError(errno.ENOENT)
+        with self.image.batch():
+            targetInode = self.findEntry(parent_inode - 1, name)
+            if targetInode == None:
+                if self.negative_timeout <= 0:
+                    raise llfuse.FUSEError(errno.ENOENT)
+                entry = llfuse.EntryAttributes() # st_ino 0 has the kernel remember the miss for a while
+                entry.st_ino = 0
+                entry.entry_timeout = self.negative_timeout
+                return entry
+            self.image.iNodes[targetInode].lookupCount += 1 # in memory only, see forget
+            return self.getattr(targetInode + 1)
         
    
     def mkdir(self, parent_inode, name, mode, ctx):
         log.debug("mkdir")
-        ninode = self.image.allocInode(2, mode)
-        self.image.writeDirectory(parent_inode - 1, inode=ninode, name=name)
-        return self.getattr(ninode + 1) # We don't explicity increment lookupCount here because it's set in class INode
+        self.checkWritable()
+        with self.image.batch():
+            ninode = self.image.allocInode(2, mode)
+            self.image.writeDirectory(parent_inode - 1, inode=ninode, name=name)
+            self.dentries.put(parent_inode - 1, name, ninode)
+            self.image.iNodes[ninode].lookupCount = 1 # returning the entry counts as a lookup
+            return self.getattr(ninode + 1)
         
 #   def mknod(self, parent_inode, name, mode, rdev, ctx):
 #       log.debug("mknod")
 #       raise llfuse.FUSEError(errno.ENOSYS)
 
+    def findEntry(self, parent, name):
+        """
+        Looks name up in parent (Image numbering) through the dentry cache,
+        which remembers misses too. Returns None if there's no such entry.
+        """
+        hit, inode = self.dentries.get(parent, name)
+        if not hit:
+            inode = self.image.lookupDirectory(parent, name)
+            self.dentries.put(parent, name, inode)
+        return inode
+
+    def openHandle(self, inode, flags):
+        """
+        Hands out a new file handle for inode. We run under llfuse's lock, so a plain counter does it.
+        """
+        fh = self.nextHandle
+        self.nextHandle += 1
+        self.handles[fh] = Handle(inode - 1, flags)
+        return fh
+
     def open(self, inode, flags, ctx):
         log.debug(f"open {inode}")
-        return inode
+        if flags & (os.O_WRONLY | os.O_RDWR | os.O_TRUNC):
+            self.checkWritable()
+        if not self.keep_cache: # llfuse always opens with keep_cache, so drop the page cache ourselves
+            self.invalidateInode(inode, attr_only=False)
+        return self.openHandle(inode, flags)
 
     def opendir(self, inode, ctx):
-        return inode
+        return self.openHandle(inode, os.O_RDONLY | os.O_DIRECTORY)
 
     def read(self, fh, off, size):
         log.debug("read")
-        return self.image.readFile(fh - 1).data[:size]
+        handle = self.handles[fh]
+        self.flushWrites(handle.inode) # so we read back what was written
+        if self.readahead:
+            self.readahead.observe(fh, handle.inode, off, size) # queues a prefetch once reads look sequential
+        with llfuse.lock_released: # Image does its own locking, so reads of different files can run at once
+            return self.image.readRange(handle.inode, off, size, handle.cursor)
 
     def readdir(self, fh, off):
-        entries = []
-        for dir in self.image.readDirectory(fh - 1):
-            attr = self.getattr(dir.inode + 1)
-            entries.append((attr.st_ino, dir.name.encode(), attr))
-
-        for (ino, name, attr) in entries:
-            if ino <= off:
-                continue
-            yield(name, attr, ino)
+        """
+        off is the directory slot to carry on from (the one after the last
+        entry we handed out), so resuming doesn't depend on inode numbers and
+        doesn't re-read anything. Entries get pulled out of the DirIndex a
+        batch at a time as the kernel keeps asking for more.
+        """
+        inode = self.handles[fh].inode
+        while True:
+            entries = self.image.listDirectory(inode, off, 256)
+            if not entries:
+                return
+            for slot, name, child in entries:
+                yield (name, self.direntAttr(child + 1), slot + 1)
+            off = entries[-1][0] + 1
+
+    def direntAttr(self, inode):
+        """
+        readdir only needs the inode number and file type out of the attributes,
+        so we skip the rest of getattr and read those off the in memory inode.
+        """
+        entry = llfuse.EntryAttributes()
+        entry.st_ino = inode
+        mode = self.image.iNodes[inode - 1].mode
+        entry.st_mode = stat.S_IFDIR if mode == 2 else stat.S_IFREG if mode == 1 else stat.S_IFLNK
+        return entry
 
     def readlink(self, inode, ctx):
         log.debug("readlink")
@@ -143,10 +356,15 @@ class LardFS(llfuse.Operations):
         if self.image.iNodes[inode - 1].mode != 3:
             log.debug("waiter.py: File wasn't a symlink")
             return
-        
+
+        target = self.image.readLink(inode - 1)
+        if target is not None:
+            return target
+
+        # old style link that shares its target's fip, so go find the target's name
         retInode = None
         for i, node in enumerate(self.image.iNodes):
-            if node.mode != 3 and node.fip == self.image.iNodes[inode - 1].fip:
+            if node.mode not in (0, 3) and node.fip == self.image.iNodes[inode - 1].fip:
                 retInode = i
                 break
 
@@ -167,9 +385,26 @@ class LardFS(llfuse.Operations):
 
     def release(self, fh):
         log.debug(f"release {fh}")
+        if self.readahead:
+            self.readahead.forget(fh)
+        self.flushHandle(fh)
+        handle = self.handles.pop(fh)
+        if handle.flags & os.O_ACCMODE != os.O_RDONLY:
+            self.image.trimPreallocation(handle.inode) # give back what writes grabbed ahead
 
     def releasedir(self, fh):
+        """
+        Once nobody has the directory open anymore, nothing holds a readdir
+        offset into it either, so that's when we squeeze out the slots
+        deletes left behind if there are enough of them.
+        """
         log.debug(f"releasedir {fh}")
+        inode = self.handles.pop(fh).inode
+        if self.read_only or not self.compact_ratio or any(h.inode == inode for h in self.handles.values()):
+            return
+        if self.image.compactSparseDirectory(inode, self.compact_ratio):
+            log.debug(f"compacted directory {inode + 1}")
+            self.invalidateInode(inode + 1)
 
 #   def removexattr(self, inode, name, ctx):
 #       log.debug("removexattr")
@@ -179,49 +414,53 @@ class LardFS(llfuse.Operations):
         You'll never guess what this function does
         """
         log.debug("rename")
-        directories = self.image.readDirectory(parent_inode_old - 1)
-        targetInode = None
-        for dir in directories:
-            if dir.name.encode() == name_old:
-                targetInode = dir.inode
-                break
-        if targetInode == None:
-            raise llfuse.FUSEError(errno.ENOENT)
-        self.image.writeDirectory(parent_inode_old - 1, name=name_old, delete=True)
-        self.image.writeDirectory(parent_inode_new - 1, inode=targetInode, name=name_new)
-        return
+        self.checkWritable()
+        with self.image.batch():
+            targetInode = self.findEntry(parent_inode_old - 1, name_old)
+            if targetInode == None:
+                raise llfuse.FUSEError(errno.ENOENT)
+            self.image.renameDirectory(parent_inode_old - 1, name_old, parent_inode_new - 1, name_new)
+            self.dentries.put(parent_inode_old - 1, name_old, None)
+            self.dentries.put(parent_inode_new - 1, name_new, targetInode)
+            self.invalidateEntry(parent_inode_old, name_old)
+            self.invalidateEntry(parent_inode_new, name_new)
+            self.invalidateInode(targetInode + 1)
+            return
 
     def rmdir(self, parent_inode, name, ctx):
         log.debug("rmdir")
-        dirs = self.image.readDirectory(parent_inode - 1)
-        inode = -1
-        for dir in dirs:
-            if dir.name.encode() == name:
-                inode = dir.inode
-        if inode == -1:
-            raise llfuse.FUSEError(errno.NOENT)
-        dirs = self.image.readDirectory(inode)
-        if len(dirs) != 0:
-            raise llfuse.FUSEError(errno.ENOTEMPTY)
-        self.image.writeDirectory(parent_inode - 1, name=name, delete=True)
-        self.image.wipe(inode)
+        self.checkWritable()
+        with self.image.batch():
+            inode = self.findEntry(parent_inode - 1, name)
+            if inode == None:
+                raise llfuse.FUSEError(errno.ENOENT)
+            if len(self.image.getDirectory(inode).names) != 0:
+                raise llfuse.FUSEError(errno.ENOTEMPTY)
+            self.image.writeDirectory(parent_inode - 1, name=name, delete=True)
+            self.dentries.put(parent_inode - 1, name, None)
+            self.dentries.dropParent(inode) # its inode number can come back as some other directory
+            self.image.wipe(inode)
                 
     def setattr(self, inode, attr, fields, fh, ctx):
         log.debug("setattr")
-        if fields.update_size:
-            self.image.truncate(inode - 1, attr.st_size)
-        if fields.update_mode:
-            self.image.iNodes[inode - 1].chmod(attr.st_mode)
-        if fields.update_uid:
-            self.image.iNodes[inode - 1].ownerUID = attr.st_uid
-        if fields.update_gid:
-            self.image.iNodes[inode - 1].ownerGID = attr.gid
-        if fields.update_atime:
-            self.image.iNodes[inode - 1].aTime = attr.st_atime_ns
-        if fields.update_mtime:
-            self.image.iNodes[inode - 1].mTime = attr.st_mtime_ns
-        self.image.writeInode(inode - 1)
-        return self.getattr(inode)
+        self.checkWritable()
+        self.flushWrites(inode - 1)
+        with self.image.batch():
+            if fields.update_size:
+                self.image.truncate(inode - 1, attr.st_size)
+            if fields.update_mode:
+                self.image.iNodes[inode - 1].chmod(attr.st_mode)
+            if fields.update_uid:
+                self.image.iNodes[inode - 1].ownerUID = attr.st_uid
+            if fields.update_gid:
+                self.image.iNodes[inode - 1].ownerGID = attr.st_gid
+            if fields.update_atime:
+                self.image.iNodes[inode - 1].aTime = attr.st_atime_ns
+            if fields.update_mtime:
+                self.image.iNodes[inode - 1].mTime = attr.st_mtime_ns
+            self.image.writeInode(inode - 1)
+            self.invalidateInode(inode, attr_only=not fields.update_size) # truncating changes the data too
+            return self.getattr(inode)
 
 
        
@@ -260,43 +499,51 @@ class LardFS(llfuse.Operations):
 
     def symlink(self, parent_inode, linkName, targetName, ctx):
         """
-        Receives a directory inode, the name of the link, and the target file name in bytes
+        Receives a directory inode, the name of the link, and the target path in bytes
         Words cannot describe my confusion and outrage when I figured out that the name of the target was passed in instead of the inode
-        Also, doing ln -s will give an input/output error, but I don't know why
+        Turns out that's the whole point though, the link just stores that path and readlink hands it back
         """
         log.debug("symlink")
-        directories = self.image.readDirectory(parent_inode - 1)
-        targetInode = None
-        for dir in directories:
-            if dir.name.encode() == targetName:
-                targetInode = dir.inode
-                break
-        if targetInode == None:
-            raise llfuse.FUSEError(errno.ENOENT)
-        ninode = self.image.allocInode(3, self.image.iNodes[targetInode].modeBits()) # allocate a new inode specifying or-ing the bits to make it a symlink
-        self.image.softLinkInode(targetInode, ninode) # copy the necessary fields
-        self.image.writeDirectory(parent_inode - 1, inode=ninode, name=linkName) # write to dir
-        return self.getattr(ninode + 1) # ret
+        self.checkWritable()
+        with self.image.batch():
+            ninode = self.image.allocInode(3, 0o777) # symlinks are always rwxrwxrwx
+            self.image.writeLink(ninode, targetName) # the path goes in the link's own sector
+            self.image.writeDirectory(parent_inode - 1, inode=ninode, name=linkName) # write to dir
+            self.dentries.put(parent_inode - 1, linkName, ninode)
+            self.image.iNodes[ninode].lookupCount = 1 # returning the entry counts as a lookup
+            return self.getattr(ninode + 1) # ret
 
     def unlink(self, parent_inode, name, ctx):
         log.debug("unlink")
-        directories = self.image.readDirectory(parent_inode - 1)
-        targetInode = None
-        for dir in directories:
-            if dir.name.encode() == name:
-                targetInode = dir.inode
-                break
-        if targetInode == None:
-            raise llfuse.FUSEError(errno.ENOENT)
-        self.image.writeDirectory(parent_inode - 1, name=name, delete=True)
-        self.image.iNodes[targetInode].linkCount -= 1
-        if self.image.iNodes[targetInode].linkCount == 0 and self.image.iNodes[targetInode].lookupCount == 0:
-            self.image.iNodes[targetInode].mode = 0 
-        self.image.writeInode(targetInode)
+        self.checkWritable()
+        with self.image.batch():
+            targetInode = self.findEntry(parent_inode - 1, name)
+            if targetInode == None:
+                raise llfuse.FUSEError(errno.ENOENT)
+            self.image.writeDirectory(parent_inode - 1, name=name, delete=True)
+            self.dentries.put(parent_inode - 1, name, None)
+            self.image.iNodes[targetInode].linkCount -= 1
+            self.image.writeInode(targetInode)
+            if self.image.iNodes[targetInode].linkCount == 0:
+                self.orphans.add(targetInode) # freed once the kernel forgets it
+                if self.image.iNodes[targetInode].lookupCount == 0:
+                    self.reclaim(targetInode)
+            self.invalidateEntry(parent_inode, name)
+            self.invalidateInode(targetInode + 1) # st_nlink changed
 
     def write(self, fh, off, buff):
         log.debug(f"write {fh}")
-        self.image.writeFile(fh - 1, off, buff)
+        self.checkWritable()
+        handle = self.handles[fh]
+        self.flushWrites(handle.inode, skip=fh) # other handles' writes go first
+        buffered = handle.buffer.add(off, buff)
+        if not buffered:
+            self.flushHandle(fh) # doesn't fit with what's buffered, so start over from this write
+            buffered = handle.buffer.add(off, buff)
+        if buffered:
+            self.buffered.setdefault(handle.inode, set()).add(fh)
+            return len(buff)
+        self.writeThrough(handle, off, buff)
         return len(buff)
         
 
@@ -317,7 +564,7 @@ def init_logging(debug=False):
 
 def parse_args(argv: list[str]):
     parser = argparse.ArgumentParser()
-    parser.add_argument("image_file", type=argparse.FileType(mode='rb+'),
+    parser.add_argument("image_file", type=str,
 			help="LARD-formatted disk image file")
     parser.add_argument('mountpoint', type=str,
                         help='Where to mount the file system')
@@ -325,19 +572,58 @@ def parse_args(argv: list[str]):
                         help='Enable debugging output')
     parser.add_argument('--debug-fuse', action='store_true', default=False,
                         help='Enable FUSE debugging output')
+    parser.add_argument('--sync', choices=['strict', 'batched', 'relaxed'], default='batched',
+                        help='How fsync makes data durable: sync every time, group commit '
+                             'concurrent fsyncs, or leave it to the OS (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of llfuse worker threads, 1 serves everything from one thread '
+                             '(default: let llfuse pick)')
+    parser.add_argument('--cache-size', type=int, default=8,
+                        help='Sector cache budget in MiB, 0 writes straight through (default: %(default)s)')
+    parser.add_argument('--no-readahead', dest='readahead', action='store_false', default=True,
+                        help='Don\'t prefetch ahead of files being read sequentially')
+    parser.add_argument('--attr-timeout', type=float, default=None,
+                        help='Seconds the kernel may cache attributes for (default: 1, a day with --read-only)')
+    parser.add_argument('--entry-timeout', type=float, default=None,
+                        help='Seconds the kernel may cache name lookups for (default: 1, a day with --read-only)')
+    parser.add_argument('--no-keep-cache', dest='keep_cache', action='store_false', default=True,
+                        help='Drop the kernel\'s page cache of a file every time it\'s opened')
+    parser.add_argument('--read-only', action='store_true', default=False,
+                        help='Mount read-only: the image is mapped read-only, every index is built at mount '
+                             'and the kernel caches attributes and lookups for a day unless told otherwise')
+    parser.add_argument('--negative-timeout', type=float, default=None,
+                        help='Seconds the kernel may remember that a name doesn\'t exist, 0 to not cache misses '
+                             '(default: 1, a day with --read-only)')
+    parser.add_argument('--sweep', action='store_true', default=False,
+                        help='Free sectors no file points at when mounting, for images from a crashed mount')
+    parser.add_argument('--defrag', type=float, nargs='?', const=4, default=None, metavar='MIB_PER_SEC',
+                        help='Defragment files in the background while mounted, moving at most this many MiB '
+                             'a second (default: 4, 0 for no limit). Progress is kept in IMAGE_FILE.defrag')
+    parser.add_argument('--compact-ratio', type=float, default=1,
+                        help='Compact a directory when its last handle is closed and it has more than this many '
+                             'empty slots for every used one, 0 to never compact (default: %(default)s)')
     return parser.parse_args(argv[1:])
 
 
 def main(argv: list[str]):
     options = parse_args(argv)
     init_logging(options.debug)
-    lardfs = LardFS(options.image_file)
+    timeout = 24 * 60 * 60 if options.read_only else 1 # nothing changes under a read-only mount
+    lardfs = LardFS(open(options.image_file, 'rb' if options.read_only else 'rb+'),
+                    cache_size=options.cache_size << 20, sync_mode=options.sync, readahead=options.readahead,
+                    attr_timeout=timeout if options.attr_timeout is None else options.attr_timeout,
+                    entry_timeout=timeout if options.entry_timeout is None else options.entry_timeout,
+                    keep_cache=options.keep_cache, read_only=options.read_only,
+                    negative_timeout=timeout if options.negative_timeout is None else options.negative_timeout,
+                    sweep=options.sweep,
+                    defrag=None if options.defrag is None else int(options.defrag * 1024 * 1024),
+                    defrag_state=options.image_file + ".defrag", compact_ratio=options.compact_ratio)
 
     log.debug("Mounting...")
 
-    llfuse.init(lardfs, options.mountpoint, ['fsname=lardfs'])
+    llfuse.init(lardfs, options.mountpoint, ['fsname=lardfs'] + (['ro'] if options.read_only else []))
     try:
-        llfuse.main()
+        llfuse.main(workers=options.workers)
     except:
         llfuse.close()
         raise